@@ -1,9 +1,6 @@
-from better_profanity import profanity
-import pandas as pd
-import pickle
 import streamlit as st
 
-musicServiceURL = 'https://music.youtube.com/search?q='
+from retrieval import moodNames, searchPages
 
 # Always keeps the selected button highlited. 
 # Code adapted from https://stackoverflow.com/questions/69478972/how-to-style-a-button-in-streamlit
@@ -40,22 +37,25 @@ def style_button_row(clicked_button_ix, n_buttons):
             style += unclicked_style % get_button_indices(ix)
     st.markdown(f"<style>{style}</style>", unsafe_allow_html=True)
 
-def produceSongResult(songIndex, artist, songName, explicit):
+# Shows a song returned by searchSongs(). Its title is already censored if the profanity filter is on.
+def produceSongResult(song):
     songResult = ''
-    songLink = musicServiceURL + songName + ' by '+ artist
-
-    oldSongName = songName
-    if explicit:
-        songName = profanity.censor(songName)
+    songLink = song['link']
+    songName = song['title']
+    artist = song['artist']
 
     # Determines if the song name was changed to obfuscate explicit content
-    if (oldSongName != songName):
-        songResult = st.markdown(f'{songIndex+1}: <a href="{songLink}" target="_blank" rel="noopener noreferrer"><b><i>{songName}</i></b></a>, by {artist}' + '<b> (Explicit)</b>', unsafe_allow_html=True)
+    if song['censored']:
+        songResult = st.markdown(f'{song["rank"]}: <a href="{songLink}" target="_blank" rel="noopener noreferrer"><b><i>{songName}</i></b></a>, by {artist}' + '<b> (Explicit)</b>', unsafe_allow_html=True)
     else: 
-        songResult = st.markdown(f'{songIndex+1}: <a href="{songLink}" target="_blank" rel="noopener noreferrer"><b><i>{songName}</i></b></a>, by {artist}', unsafe_allow_html=True)
+        songResult = st.markdown(f'{song["rank"]}: <a href="{songLink}" target="_blank" rel="noopener noreferrer"><b><i>{songName}</i></b></a>, by {artist}', unsafe_allow_html=True)
 
     return songResult
 
+# Moves to another page of results. Called by the page buttons, before the page is shown.
+def changePage(step):
+    st.session_state['page'] += step
+
 def renderWebApp():
     st.set_page_config(page_title='My Kind of Music - Find a song on your desired mood and keywords', page_icon='📻', layout='centered', initial_sidebar_state='collapsed', menu_items=None)
     # CSS format to eliminate the right menu page and to format the size of face icons
@@ -70,13 +70,6 @@ def renderWebApp():
     if 'mood' not in st.session_state:
         st.session_state['mood'] = 0
 
-    # Read music dataset (csv) and the inverted index dictionary (bm5.pkl)
-    df_read = pd.read_csv("music.csv")
-    with open("bm25.pkl", "rb") as tf:
-        bm25_read = pickle.load(tf)
-
-    df_read.sentiment = df_read.sentiment.astype('int')
-
     st.markdown("## Step 1: Select the desired mood", unsafe_allow_html=True)
     st.write()
 
@@ -98,8 +91,6 @@ def renderWebApp():
         if col5.button("😀", on_click=style_button_row,kwargs={'clicked_button_ix': 5, 'n_buttons': 5}):
             st.session_state['mood'] = 5
 
-    mood_list = ['very sad', 'sad', 'neutral', 'happy', 'very happy']
-
     st.write("")
     st.write("")
 
@@ -114,30 +105,42 @@ def renderWebApp():
             # Apply the style to the selected button
             style_button_row(st.session_state['mood'], 5)
 
-            df_mood = df_read[df_read.sentiment == mood]
-
-            tokenized_query = query.lower().split(" ")
-            tokenized_query = [x for x in tokenized_query if x!=""]
-            st.markdown(f"### <center>Some songs that suggest a *** {mood_list[mood-1]} *** mood</center>", unsafe_allow_html=True)
-
-            # Find the results with best retrieval score in the bm25 dictionary
-            results = bm25_read[mood].get_top_n(tokenized_query, df_mood.title.values, n=10)
+            st.markdown(f"### <center>Some songs that suggest a *** {moodNames[mood-1]} *** mood</center>", unsafe_allow_html=True)
+
+            # Find the results with best retrieval score in the bm25 index, with the same retrieval core
+            # as the HTTP server (server.py). Song database and indexes are loaded once per process.
+            # Songs are scored once per query: the best ones are kept in the session and shown 10 at a
+            # time, so moving to another page does not score songs again.
+            # Only songs that contain at least one of the keywords are returned, so there may be fewer than 10
+            searchKey = (mood, query, profanity_filter)
+            if st.session_state.get('searchKey') != searchKey:
+                st.session_state['searchKey'] = searchKey
+                st.session_state['resultPages'] = searchPages(mood, query, 10, profanity_filter)
+                st.session_state['page'] = 1
+            resultPages = st.session_state['resultPages']
+            page = min(max(st.session_state['page'], 1), resultPages.getPageCount())
+            st.session_state['page'] = page
+            results = resultPages.getPage(page)
+            if len(results) == 0:
+                st.write("No songs matched your keywords. Try different keywords or another mood.")
             col6, col7 = st.columns(2)
 
             with col6:
-                for i in range(5):
-                    artist = df_read[df_read.title == results[i]].artist.values[0]
-                    # Implementing the profanity filter over the song name
-                    # This will be needed for the lyrics in case we decide to show it too 
-                    songName = results[i]
-                    produceSongResult(i, artist, songName, profanity_filter)
+                for song in results[:5]:
+                    produceSongResult(song)
             with col7:
-                for i in range(5, 10):
-                    artist = df_read[df_read.title == results[i]].artist.values[0]
-                    # Implementing the profanity filter over the song name
-                    # This will be needed for the lyrics in case we decide to show it too 
-                    songName = results[i]
-                    produceSongResult(i, artist, songName, profanity_filter)
+                for song in results[5:]:
+                    produceSongResult(song)
+
+            if resultPages.getPageCount() > 1:
+                st.caption(f'Songs {results[0]["rank"]} to {results[-1]["rank"]} of {len(resultPages)}')
+                col8, col9 = st.columns(2)
+                with col8:
+                    if page > 1:
+                        st.button('Previous songs', key='previousPage', on_click=changePage, kwargs={'step': -1})
+                with col9:
+                    if page < resultPages.getPageCount():
+                        st.button('More songs', key='nextPage', on_click=changePage, kwargs={'step': 1})
 
         except Exception as e:
             st.error("Error entering your query")
@@ -0,0 +1,395 @@
+## benchmark.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## BENCHMARKS OF DATA PREPARATION AND SONG RETRIEVAL ON SYNTHETIC SONG DATABASES
+
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+try:
+    import resource     # Peak memory of a process. Not available on Windows
+except ImportError:
+    resource = None
+
+resultsVersion = 1
+defaultSongCounts = [1000]
+defaultQueryCount = 2000
+
+# Words used to write synthetic lyrics: common lyric words, plus words with a strong sentiment so songs
+# spread across the five sentiment categories
+lyricWords = ('i you me we my your our the a in on of to and but for with all now never always again '
+    'night day time heart eyes love life world home road light rain fire sky sun moon dream dreams '
+    'baby girl boy man woman friend friends mind soul body hands face voice song words way place '
+    'go come know feel see want need take make give hold run fall stay leave find lose believe '
+    'cry try fly die wait call dance sing walk talk burn break shine turn move live breathe '
+    'tonight tomorrow yesterday forever together alone away back down up out over inside '
+    'cold warm dark bright old young wild free lost broken empty little long last only real').split()
+happyWords = ('happy joy smile laugh beautiful sweet wonderful sunshine glory celebrate '
+    'kiss hope peace paradise heaven lucky amazing perfect shining gold').split()
+sadWords = ('sad pain tears lonely hurt hate fear kill dead grave cry broken sorrow '
+    'misery suffer bleed scream lies cruel war poison goodbye regret').split()
+nameWords = ('blue black red silver golden crystal iron electric midnight velvet stone '
+    'river ocean desert city highway thunder shadow mirror echo garden').split()
+nameNouns = ('kings queens riders hearts wolves angels machines ghosts brothers sisters '
+    'lights roses saints kids dogs birds stars lions waves radio').split()
+
+# Misspells a word the way users do: a letter missing, wrong or swapped with the next one
+def misspellWord(rng, word):
+    position = rng.randrange(len(word))
+    edit = rng.randrange(3)
+    if edit == 0 and len(word) > 1:
+        return word[:position] + word[position + 1:]
+    if edit == 1 or position == len(word) - 1:
+        return word[:position] + rng.choice('abcdefghijklmnopqrstuvwxyz') + word[position + 1:]
+    return word[:position] + word[position + 1] + word[position] + word[position + 2:]
+
+# Writes a synthetic song database with the layout of database_source:
+# [ArtistFirstLetter]/[ArtistName]/[AlbumName]/[LyricsFile], with lyrics followed by the metadata footer.
+# About 2% of songs have short lyrics and 1% are empty, so every outcome of dataprep.py is exercised.
+def generateDatabase(dbDir, songCount, seed=0, songsPerAlbum=10, albumsPerArtist=3):
+    rng = random.Random(seed)
+    songsWritten = 0
+    artistNumber = 0
+    while songsWritten < songCount:
+        artistNumber += 1
+        artist = rng.choice(nameWords).title() + ' ' + rng.choice(nameNouns).title() + ' ' + str(artistNumber)
+        for albumNumber in range(albumsPerArtist):
+            if songsWritten == songCount:
+                break
+            album = rng.choice(nameWords).title() + ' ' + rng.choice(lyricWords).title() + ' ' + str(albumNumber + 1)
+            albumPath = os.path.join(dbDir, artist[0], artist, album)
+            os.makedirs(albumPath, exist_ok=True)
+            for songNumber in range(min(songsPerAlbum, songCount - songsWritten)):
+                title = rng.choice(lyricWords).title() + ' ' + rng.choice(nameWords).title() + ' ' + str(songNumber + 1)
+                lyrics = generateLyrics(rng)
+                with open(os.path.join(albumPath, title), 'w', encoding='utf-8') as songFile:
+                    songFile.write(lyrics + '\n\n\n_______________\nName    ' + title + '\nArtist  ' + artist + '\nAlbum   ' + album + '\n')
+                songsWritten += 1
+    return songsWritten
+
+# Lyrics-like text: verses of four to eight lines separated by empty lines. Each song leans towards
+# happy or sad words, so compounds cover the whole range.
+def generateLyrics(rng):
+    kind = rng.random()
+    if kind < 0.01:
+        return ''
+    if kind < 0.03:
+        return ' '.join(rng.choice(lyricWords) for _ in range(rng.randint(3, 15)))
+
+    mood = rng.random()
+    verses = []
+    for _ in range(rng.randint(3, 6)):
+        lines = []
+        for _ in range(rng.randint(4, 8)):
+            words = []
+            for _ in range(rng.randint(4, 9)):
+                draw = rng.random()
+                if draw < 0.12 * mood:
+                    words.append(rng.choice(happyWords))
+                elif draw > 1 - 0.12 * (1 - mood):
+                    words.append(rng.choice(sadWords))
+                else:
+                    words.append(rng.choice(lyricWords))
+            lines.append(' '.join(words).capitalize())
+        verses.append('\n'.join(lines))
+    # Repeat the first verse as a chorus, as most songs do
+    verses.insert(2, verses[0])
+    return '\n\n'.join(verses) + '\n'
+
+# Peak resident memory of the current process in MB, or None if it cannot be measured
+def getPeakRss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return round(peak / 1024 / 1024, 1)
+    return round(peak / 1024, 1)
+
+# Latency percentiles (milliseconds) and throughput of a list of query latencies (seconds)
+def summarizeLatencies(latencies):
+    latencies = np.array(latencies) * 1000
+    return {
+        'queries': len(latencies),
+        'p50Ms': round(float(np.percentile(latencies, 50)), 4),
+        'p95Ms': round(float(np.percentile(latencies, 95)), 4),
+        'p99Ms': round(float(np.percentile(latencies, 99)), 4),
+        'qps': round(float(len(latencies) / (latencies.sum() / 1000)), 1) if latencies.sum() > 0 else None
+    }
+
+# Categorizes the songs of workDir/database_source, as "python dataprep.py" does. Throughput counts every
+# song file processed, including songs that were too short, not in English or failed.
+def benchmarkCategorize(scope, workers):
+    from dataprep import categorizeSongs, songFile
+    from ingest import SongSource
+    import pandas as pd
+
+    with SongSource('database_source') as songSource:
+        songsProcessed = len(songSource)
+
+    startTime = time.perf_counter()
+    categorizeSongs(scope, workers)
+    elapsedTime = time.perf_counter() - startTime
+    songCount = len(pd.read_csv(songFile)) if os.path.isfile(songFile) else 0
+    if songCount == 0:
+        raise Exception('categorizeSongs() did not categorize any song. Check benchmark-categorize.log in the work directory.')
+    return {
+        'seconds': round(elapsedTime, 3),
+        'songsPerSecond': round(songsProcessed / elapsedTime, 1),
+        'songsProcessed': songsProcessed,
+        'songsCategorized': songCount,
+        'scope': scope,
+        'workers': workers,
+        'peakRssMB': getPeakRss()
+    }
+
+# Builds the indexes of the songs categorized by benchmarkCategorize(), first tokenizing every song and then
+# again with the tokens cached by the first build, as when the index is rebuilt with other BM25 parameters
+def benchmarkIndex():
+    from dataprep import createIndexes, indexFile
+    from tokenization import tokenCacheFile
+
+    for path in [indexFile, tokenCacheFile]:
+        if os.path.isfile(path):
+            os.remove(path)
+    startTime = time.perf_counter()
+    createIndexes()
+    elapsedTime = time.perf_counter() - startTime
+    if not os.path.isfile(indexFile):
+        raise Exception('createIndexes() did not write ' + indexFile + '. Check benchmark-index.log in the work directory.')
+    cachedStart = time.perf_counter()
+    createIndexes()
+    cachedTime = time.perf_counter() - cachedStart
+    return {
+        'seconds': round(elapsedTime, 3),
+        'cachedTokensSeconds': round(cachedTime, 3),
+        'indexBytes': os.path.getsize(indexFile),
+        'tokenCacheBytes': os.path.getsize(tokenCacheFile) if os.path.isfile(tokenCacheFile) else 0,
+        'peakRssMB': getPeakRss()
+    }
+
+# Runs random queries through searchSongs(), the retrieval core of renderWebApp() and server.py: tokenization
+# of the keywords, top 10 songs of the mood, lookup of their fields and profanity censoring. Queries are
+# drawn with a skewed distribution from a pool of queries, so some are repeated as they are by real users
+# and the query cache is used. Queries are then run again directly on the indexes, without the cache, to
+# measure the search itself.
+def benchmarkQueries(queryCount, seed=0):
+    from resources import getResources
+    from retrieval import searchSongs, tokenizeQuery
+
+    loadStart = time.perf_counter()
+    resources = getResources()
+    loadTime = time.perf_counter() - loadStart
+
+    rng = random.Random(seed)
+    words = lyricWords + happyWords + sadWords
+    queryPool = [(rng.randint(1, 5), ' '.join(rng.choice(words) for _ in range(rng.randint(1, 3)))) for _ in range(max(1, queryCount // 4))]
+    poolWeights = [1 / (rank + 1) for rank in range(len(queryPool))]
+    queries = rng.choices(queryPool, weights=poolWeights, k=queryCount)
+
+    appLatencies = []
+    engineLatencies = []
+    for mood, query in queries:
+        startTime = time.perf_counter()
+        searchSongs(mood, query, 10, True, resources)
+        appLatencies.append(time.perf_counter() - startTime)
+
+    for mood, query in queries:
+        startTime = time.perf_counter()
+        resources.searchIndexes(mood, tokenizeQuery(query), 10)
+        engineLatencies.append(time.perf_counter() - startTime)
+
+    # Expansion of queries with a misspelled or partially typed word (cut after its first letters)
+    expansionLatencies = []
+    for mood, query in queries:
+        words = query.split()
+        position = rng.randrange(len(words))
+        if len(words[position]) > 4 and rng.random() < 0.5:
+            words[position] = words[position][:rng.randint(3, len(words[position]) - 1)]
+        else:
+            words[position] = misspellWord(rng, words[position])
+        startTime = time.perf_counter()
+        resources.expandQuery(tokenizeQuery(' '.join(words)))
+        expansionLatencies.append(time.perf_counter() - startTime)
+
+    return {
+        'loadSeconds': round(loadTime, 4),
+        'app': summarizeLatencies(appLatencies),
+        'engine': summarizeLatencies(engineLatencies),
+        'expansion': summarizeLatencies(expansionLatencies),
+        'expansionStats': resources.queryExpander.getStats() if resources.queryExpander is not None else None,
+        'cache': resources.queryCache.getStats(),
+        'peakRssMB': getPeakRss()
+    }
+
+# Entry point of the process that runs a single stage. Every stage runs in a new process, so its peak
+# memory is not affected by the stages before it. Output of dataprep.py goes to a log in workDir.
+def runStage(stage, workDir, args, resultQueue):
+    os.chdir(workDir)
+    try:
+        with open('benchmark-' + stage + '.log', 'w', encoding='utf-8') as stageLog:
+            sys.stdout = stageLog
+            if stage == 'categorize':
+                result = benchmarkCategorize(*args)
+            elif stage == 'index':
+                result = benchmarkIndex()
+            else:
+                result = benchmarkQueries(*args)
+        resultQueue.put((True, result))
+    except BaseException as e:
+        resultQueue.put((False, repr(e)))
+
+stageResultPoll = 1     # Seconds between checks that a stage process is still running
+
+def runStageProcess(stage, workDir, args=()):
+    context = multiprocessing.get_context('spawn')
+    resultQueue = context.Queue()
+    process = context.Process(target=runStage, args=(stage, workDir, args, resultQueue))
+    process.start()
+    # The stage process may crash without sending a result (e.g. killed when out of memory)
+    while True:
+        try:
+            succeeded, result = resultQueue.get(timeout=stageResultPoll)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                try:
+                    succeeded, result = resultQueue.get(timeout=stageResultPoll)
+                    break
+                except queue.Empty:
+                    raise Exception('Benchmark stage ' + stage + ' failed: its process exited with code ' + str(process.exitcode) + ' without a result. Check benchmark-' + stage + '.log in the work directory.')
+    process.join()
+    if not succeeded:
+        raise Exception('Benchmark stage ' + stage + ' failed: ' + result)
+    return result
+
+# Generates a database of songCount songs in workDir and measures every stage on it
+def benchmarkSongCount(workDir, songCount, scope, workers, queryCount, seed):
+    os.makedirs(os.path.join(workDir, 'logs'), exist_ok=True)
+    startTime = time.perf_counter()
+    generateDatabase(os.path.join(workDir, 'database_source'), songCount, seed)
+    run = {'songs': songCount, 'seed': seed, 'generateSeconds': round(time.perf_counter() - startTime, 3)}
+
+    print('Categorizing', str(songCount), 'songs...')
+    run['categorize'] = runStageProcess('categorize', workDir, (scope, workers))
+    print(' --- ' + str(run['categorize']['songsPerSecond']), 'songs per second')
+    print('Creating indexes...')
+    run['index'] = runStageProcess('index', workDir)
+    print(' --- ' + str(run['index']['seconds']), 'seconds (' + str(run['index']['cachedTokensSeconds']), 'seconds with cached tokens), peak memory', str(run['index']['peakRssMB']), 'MB')
+    print('Running', str(queryCount), 'queries...')
+    run['query'] = runStageProcess('query', workDir, (queryCount, seed))
+    print(' --- p50', str(run['query']['app']['p50Ms']), 'ms, p95', str(run['query']['app']['p95Ms']), 'ms, p99', str(run['query']['app']['p99Ms']), 'ms,', str(run['query']['app']['qps']), 'queries per second')
+    print(' --- query expansion p50', str(run['query']['expansion']['p50Ms']), 'ms, p99', str(run['query']['expansion']['p99Ms']), 'ms')
+    return run
+
+# Commit the benchmark runs on, so results of different commits can be told apart
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+# Prints how each metric changed since a previous results file, for the song counts both files have
+def compareResults(results, previousFile):
+    with open(previousFile, 'r', encoding='utf-8') as pf:
+        previous = json.load(pf)
+    previousRuns = {run['songs']: run for run in previous['runs']}
+    metrics = [('categorize', 'songsPerSecond'), ('index', 'seconds'), ('index', 'cachedTokensSeconds'), ('index', 'peakRssMB'),
+               ('query', 'app', 'p50Ms'), ('query', 'app', 'p99Ms'), ('query', 'engine', 'p50Ms'), ('query', 'engine', 'p99Ms'),
+               ('query', 'expansion', 'p50Ms'), ('query', 'expansion', 'p99Ms')]
+
+    print('')
+    print('Compared with', previousFile, '(commit ' + str(previous.get('commit')) + '):')
+    for run in results['runs']:
+        previousRun = previousRuns.get(run['songs'])
+        if previousRun is None:
+            continue
+        print(' --- ' + str(run['songs']), 'songs:')
+        for metric in metrics:
+            value, previousValue = run, previousRun
+            for key in metric:
+                value, previousValue = value.get(key, {}), previousValue.get(key, {})
+            if isinstance(value, (int, float)) and isinstance(previousValue, (int, float)) and previousValue > 0:
+                print('           ' + '.'.join(metric) + ':', str(previousValue), '->', str(value), '(' + str(round(value / previousValue, 2)) + 'x)')
+
+# Usage: python benchmark.py [--songs 1000,10000] [--workers N] [--scope verse] [--queries 2000]
+#        [--seed 0] [--output file] [--compare previous results file] [--work-dir directory]
+# Databases are generated in a temporary directory, removed at the end unless --work-dir is given.
+if __name__ == '__main__':
+    songCounts = defaultSongCounts
+    workers = 1
+    scope = 'verse'
+    queryCount = defaultQueryCount
+    seed = 0
+    outputFile = None
+    previousFile = None
+    workDir = None
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if len(args) == 0:
+            raise Exception("Missing value for " + arg + " argument.")
+        value = args.pop(0)
+        if arg == '--songs':
+            songCounts = [int(songCount) for songCount in value.split(',')]
+        elif arg == '--workers':
+            workers = int(value)
+        elif arg == '--scope':
+            scope = value.lower()
+        elif arg == '--queries':
+            queryCount = int(value)
+        elif arg == '--seed':
+            seed = int(value)
+        elif arg == '--output':
+            outputFile = value
+        elif arg == '--compare':
+            previousFile = value
+        elif arg == '--work-dir':
+            workDir = os.path.abspath(value)
+        else:
+            raise Exception("Invalid argument: " + arg)
+
+    startedAt = time.strftime('%Y%m%d_%H%M%S')
+    if outputFile is None:
+        outputFile = os.path.join('logs', 'benchmark-' + startedAt + '.json')
+
+    results = {
+        'version': resultsVersion,
+        'commit': getCommit(),
+        'startedAt': startedAt,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'runs': []
+    }
+
+    for songCount in songCounts:
+        runDir = tempfile.mkdtemp(prefix='mykindofmusic-benchmark-') if workDir is None else os.path.join(workDir, str(songCount))
+        print('')
+        print('Benchmarking', str(songCount), 'songs in', runDir)
+        try:
+            results['runs'].append(benchmarkSongCount(runDir, songCount, scope, workers, queryCount, seed))
+        finally:
+            if workDir is None:
+                shutil.rmtree(runDir, ignore_errors=True)
+
+    os.makedirs(os.path.dirname(os.path.abspath(outputFile)), exist_ok=True)
+    with open(outputFile, 'w', encoding='utf-8') as of:
+        json.dump(results, of, indent=2)
+    print('')
+    print('Results written to', outputFile)
+
+    if previousFile is not None:
+        compareResults(results, previousFile)
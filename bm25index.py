@@ -0,0 +1,470 @@
+## bm25index.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## SPARSE BM25 INVERTED INDEX USED FOR SONG RETRIEVAL
+
+import json
+import math
+import os
+
+import numpy as np
+
+# Binary index file format (bm25.idx). One or more named indexes are stored in one file:
+#   8 bytes   magic number 'MKOMBM25'
+#   4 bytes   format version (uint32, little endian)
+#   4 bytes   length of the header (uint32, little endian)
+#   header    JSON: BM25 parameters of each index, and the offset, type and length of each of its arrays
+#   arrays    flat little-endian arrays, each starting at a multiple of 64 bytes
+# The file is opened with numpy.memmap, so loading it does not read the arrays: pages are read when a
+# query touches them, and are shared by all processes that open the same file through the OS page cache.
+# Version 1 files hold one index per mood (named '1' to '5'). Version 2 files hold a single index of
+# all songs, named 'all', with the mood of each document in its 'moods' array. Version 3 files add the
+# delete index of the vocabulary (see DeleteIndex), used to correct misspelled query terms.
+indexMagic = b'MKOMBM25'
+indexVersion = 3
+supportedIndexVersions = [1, 2, 3]
+arrayAlignment = 64
+
+# Name of the index of all songs, filtered by mood at query time
+unifiedIndexName = 'all'
+
+# Arrays stored for each index, and their types
+indexArrays = {
+    'termBytes': '<u1',         # Terms encoded in UTF-8, concatenated in sorted order
+    'termOffsets': '<i8',       # Start of each term in termBytes (numTerms + 1)
+    'postingOffsets': '<i8',
+    'postingDocs': '<i4',
+    'postingFreqs': '<i4',
+    'docLengths': '<i4',
+    'docNorms': '<f8',
+    'idf': '<f8',
+    'songIds': '<i4',
+    'moods': '<i1',             # Mood (sentiment 1 to 5) of each document. Only in indexes of all songs
+    'deleteBytes': '<u1',       # Delete variants of the terms (see DeleteIndex), concatenated in sorted order
+    'deleteOffsets': '<i8',     # Start of each delete variant in deleteBytes (numVariants + 1)
+    'deleteTermOffsets': '<i8', # Terms of delete variant v are deleteTermIds[deleteTermOffsets[v]:deleteTermOffsets[v+1]]
+    'deleteTermIds': '<i4'
+}
+
+# Settings of the delete index written with each index: edit distance covered, and characters of each
+# term the delete variants are computed from (longer terms are matched on their first characters)
+maxEditDistance = 2
+deletePrefixLength = 7
+
+# Bitset of a set of moods: bit m is set for mood m. A document passes the filter if the bit of its
+# mood is set, so filtering by one mood or by any combination of moods costs the same.
+def getMoodMask(moods):
+    moodMask = 0
+    for mood in moods:
+        moodMask |= 1 << int(mood)
+    return moodMask
+
+# Term -> term id lookup over the sorted terms of an index file, without building a dictionary.
+# Term ids are the position of the term in sorted order; lookups are a binary search.
+class SortedVocabulary:
+    def __init__(self, termBytes, termOffsets):
+        self.termBytes = termBytes
+        self.termOffsets = termOffsets
+
+    # Builds the sorted vocabulary of a term -> term id dictionary.
+    # Returns the vocabulary and, for each new term id, the term id in the dictionary.
+    @classmethod
+    def fromDict(cls, vocabulary):
+        terms = sorted(vocabulary)
+        encodedTerms = [term.encode('utf-8') for term in terms]
+        termOffsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        termOffsets[1:] = np.cumsum([len(term) for term in encodedTerms])
+        termBytes = np.frombuffer(b''.join(encodedTerms), dtype=np.uint8)
+        oldTermIds = np.array([vocabulary[term] for term in terms], dtype=np.int64)
+        return cls(termBytes, termOffsets), oldTermIds
+
+    def __len__(self):
+        return len(self.termOffsets) - 1
+
+    def getTerm(self, termId):
+        return self.termBytes[self.termOffsets[termId]:self.termOffsets[termId + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for termId in range(len(self)):
+            yield self.getTerm(termId)
+
+    # Position of the first term that is not smaller than key (UTF-8 bytes), by binary search.
+    # UTF-8 byte order is the same as the code point order used to sort the terms.
+    def lowerBound(self, key):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            middleTerm = self.termBytes[self.termOffsets[middle]:self.termOffsets[middle + 1]].tobytes()
+            if middleTerm < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Returns the term id of a term, or default if the term is not in the vocabulary.
+    def get(self, term, default=None):
+        key = term.encode('utf-8')
+        termId = self.lowerBound(key)
+        if termId < len(self) and self.termBytes[self.termOffsets[termId]:self.termOffsets[termId + 1]].tobytes() == key:
+            return termId
+        return default
+
+    # Returns (first, last + 1) term ids of the terms that start with prefix. Terms sharing a prefix are
+    # contiguous in sorted order. No UTF-8 sequence contains the byte 0xff, so it sorts after them all.
+    def getPrefixRange(self, prefix):
+        key = prefix.encode('utf-8')
+        return self.lowerBound(key), self.lowerBound(key + b'\xff')
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __getitem__(self, term):
+        termId = self.get(term)
+        if termId is None:
+            raise KeyError(term)
+        return termId
+
+# All the strings obtained by deleting up to maxDistance characters from a term, including the term itself
+def getDeletes(term, maxDistance):
+    deletes = {term}
+    edits = [term]
+    for _ in range(maxDistance):
+        edits = [edit[:position] + edit[position + 1:] for edit in edits for position in range(len(edit))]
+        deletes.update(edits)
+    return deletes
+
+# Symmetric delete index of a vocabulary, to find the terms within a small edit distance of a word
+# without comparing it with every term: two words are within edit distance d only if deleting up to d
+# characters from each gives a common string. Every term is stored under each of its delete variants,
+# so a lookup generates the delete variants of the word and collects the terms stored under them.
+# Candidates still need their edit distance checked. Variants are computed from the first prefixLength
+# characters of each term, which keeps the index small: longer terms are matched on their beginning.
+# Variants are stored sorted, like the terms of the vocabulary, and looked up by binary search.
+class DeleteIndex:
+    def __init__(self, variants, termOffsets, termIds, maxDistance=maxEditDistance, prefixLength=deletePrefixLength):
+        self.variants = variants            # SortedVocabulary of the delete variants
+        self.termOffsets = termOffsets      # int64[numVariants + 1]
+        self.termIds = termIds              # int32[numEntries], term ids of each variant in CSR form
+        self.maxDistance = maxDistance
+        self.prefixLength = prefixLength
+
+    # Builds the delete index of the terms of a vocabulary, in term id order
+    @classmethod
+    def build(cls, terms, maxDistance=maxEditDistance, prefixLength=deletePrefixLength):
+        variantTerms = {}
+        for termId, term in enumerate(terms):
+            for variant in getDeletes(term[:prefixLength], maxDistance):
+                variantTerms.setdefault(variant, []).append(termId)
+
+        variants, oldVariantIds = SortedVocabulary.fromDict({variant: variantId for variantId, variant in enumerate(variantTerms)})
+        termLists = list(variantTerms.values())
+        termLists = [termLists[variantId] for variantId in oldVariantIds]
+        termOffsets = np.zeros(len(termLists) + 1, dtype=np.int64)
+        termOffsets[1:] = np.cumsum([len(termIds) for termIds in termLists])
+        termIds = np.fromiter((termId for termIds in termLists for termId in termIds), dtype=np.int32, count=termOffsets[-1])
+        return cls(variants, termOffsets, termIds, maxDistance, prefixLength)
+
+    # Term ids of the terms that may be within maxDistance edits of word (maxDistance up to the distance
+    # the index was built for), in ascending order
+    def getCandidates(self, word, maxDistance):
+        candidates = []
+        for variant in getDeletes(word[:self.prefixLength], min(maxDistance, self.maxDistance)):
+            variantId = self.variants.get(variant)
+            if variantId is not None:
+                candidates.append(self.termIds[self.termOffsets[variantId]:self.termOffsets[variantId + 1]])
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=np.int32)
+        return np.unique(np.concatenate(candidates))
+
+    def getFileArrays(self):
+        return {
+            'deleteBytes': self.variants.termBytes,
+            'deleteOffsets': self.variants.termOffsets,
+            'deleteTermOffsets': self.termOffsets,
+            'deleteTermIds': self.termIds
+        }
+
+# BM25 (Okapi) index stored as postings lists in CSR form: the postings of term t are
+# postingDocs[postingOffsets[t]:postingOffsets[t+1]] (document ids, ascending) and the matching
+# term frequencies in postingFreqs. Scores are identical to rank_bm25's BM25Okapi, including its
+# epsilon floor for negative idf values, but a query only touches documents that contain one of
+# its terms and the top results are selected with a partial sort.
+# Documents are numbered by their position in the indexed corpus; songIds maps each position to the
+# song id (row of music.csv) so that retrieval results can be looked up in the SongCatalog.
+# An index of songs of all moods has the mood of each document in moods, and queries can be limited
+# to any set of moods. idf is then computed over all songs, so scores can be compared across moods.
+# Indexes read from version 3 files have the delete index of their vocabulary in deleteIndex. It is
+# built when the index is saved, as its term ids are those of the sorted vocabulary of the file.
+class BM25Index:
+    def __init__(self, vocabulary, postingOffsets, postingDocs, postingFreqs, docLengths, idf, avgdl, k1=1.5, b=0.75, epsilon=0.25, songIds=None, docNorms=None, moods=None, deleteIndex=None):
+        self.vocabulary = vocabulary                # term -> term id (dict, or SortedVocabulary for index files)
+        self.postingOffsets = postingOffsets        # int64[numTerms + 1]
+        self.postingDocs = postingDocs              # int32[numPostings]
+        self.postingFreqs = postingFreqs            # int32[numPostings]
+        self.docLengths = docLengths                # int32[numDocs]
+        self.idf = idf                              # float64[numTerms]
+        self.avgdl = avgdl
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.corpusSize = len(docLengths)
+        self.songIds = np.arange(self.corpusSize, dtype=np.int32) if songIds is None else np.asarray(songIds, dtype=np.int32)
+        self.moods = None if moods is None else np.asarray(moods, dtype=np.int8)     # int8[numDocs], or None
+        self.deleteIndex = deleteIndex              # DeleteIndex of the sorted vocabulary, or None
+
+        # Document length normalization, computed exactly like BM25Okapi.get_scores does
+        if docNorms is None:
+            docNorms = self.k1 * (1 - self.b + self.b * docLengths / self.avgdl)
+        self.docNorms = docNorms
+
+    # Builds the index from a tokenized corpus (a list of token lists, one per document)
+    # songIds holds the song id of each document; when omitted, songs are numbered from zero
+    # moods holds the mood of each document, for indexes of songs of all moods
+    @classmethod
+    def build(cls, corpus, k1=1.5, b=0.75, epsilon=0.25, songIds=None, moods=None):
+        vocabulary = {}
+        termDocs = []
+        termFreqs = []
+        docLengths = np.zeros(len(corpus), dtype=np.int32)
+        numTokens = 0
+
+        for docId, document in enumerate(corpus):
+            docLengths[docId] = len(document)
+            numTokens += len(document)
+
+            frequencies = {}
+            for word in document:
+                frequencies[word] = frequencies.get(word, 0) + 1
+
+            for word, freq in frequencies.items():
+                termId = vocabulary.get(word)
+                if termId is None:
+                    termId = len(vocabulary)
+                    vocabulary[word] = termId
+                    termDocs.append([])
+                    termFreqs.append([])
+                termDocs[termId].append(docId)
+                termFreqs[termId].append(freq)
+
+        avgdl = numTokens / len(corpus)
+        postingOffsets, postingDocs, postingFreqs = cls._toCSR(termDocs, termFreqs)
+
+        # Document frequency of each term is the length of its postings list
+        docFreqs = np.diff(postingOffsets)
+        idf = cls._computeIdf(docFreqs, len(corpus), epsilon)
+
+        return cls(vocabulary, postingOffsets, postingDocs, postingFreqs, docLengths, idf, avgdl, k1, b, epsilon, songIds, moods=moods)
+
+    # Converts an existing rank_bm25 BM25Okapi object (e.g. from an older bm25.pkl) without re-tokenizing
+    @classmethod
+    def fromOkapi(cls, okapi, songIds=None):
+        vocabulary = {}
+        termDocs = []
+        termFreqs = []
+        for docId, frequencies in enumerate(okapi.doc_freqs):
+            for word, freq in frequencies.items():
+                termId = vocabulary.get(word)
+                if termId is None:
+                    termId = len(vocabulary)
+                    vocabulary[word] = termId
+                    termDocs.append([])
+                    termFreqs.append([])
+                termDocs[termId].append(docId)
+                termFreqs[termId].append(freq)
+
+        postingOffsets, postingDocs, postingFreqs = cls._toCSR(termDocs, termFreqs)
+        docLengths = np.array(okapi.doc_len, dtype=np.int32)
+        idf = np.array([okapi.idf[word] for word in vocabulary], dtype=np.float64)
+
+        return cls(vocabulary, postingOffsets, postingDocs, postingFreqs, docLengths, idf, okapi.avgdl, okapi.k1, okapi.b, okapi.epsilon, songIds)
+
+    # Flattens per-term lists of (doc id, term frequency) into CSR arrays
+    @staticmethod
+    def _toCSR(termDocs, termFreqs):
+        postingOffsets = np.zeros(len(termDocs) + 1, dtype=np.int64)
+        postingOffsets[1:] = np.cumsum([len(docs) for docs in termDocs])
+        postingDocs = np.fromiter((docId for docs in termDocs for docId in docs), dtype=np.int32, count=postingOffsets[-1])
+        postingFreqs = np.fromiter((freq for freqs in termFreqs for freq in freqs), dtype=np.int32, count=postingOffsets[-1])
+        return postingOffsets, postingDocs, postingFreqs
+
+    # Okapi idf with the epsilon floor used by rank_bm25: terms that appear in more than half of the
+    # documents would get a negative idf, so they get epsilon * average idf instead. Computed term by
+    # term with math.log, in vocabulary order, so values match BM25Okapi bit for bit.
+    @staticmethod
+    def _computeIdf(docFreqs, corpusSize, epsilon):
+        idf = np.zeros(len(docFreqs), dtype=np.float64)
+        idfSum = 0
+        for termId, freq in enumerate(docFreqs.tolist()):
+            idf[termId] = math.log(corpusSize - freq + 0.5) - math.log(freq + 0.5)
+            idfSum += idf[termId]
+        if len(idf) > 0:
+            averageIdf = idfSum / len(idf)
+            idf[idf < 0] = epsilon * averageIdf
+        return idf
+
+    # Scores only the documents that contain at least one query term. With moods (a collection of moods),
+    # only documents of those moods are scored; the index must have been built with moods.
+    # weights has a weight for each query term (1 if not given), for terms added by query expansion.
+    # songMask (a boolean array indexed by song id) limits scoring to the songs where it is True.
+    # Returns (document ids in ascending order, their BM25 scores)
+    def getScores(self, query, moods=None, weights=None, songMask=None):
+        if weights is None:
+            weights = [1] * len(query)
+        termWeights = [(self.vocabulary.get(q), weight) for q, weight in zip(query, weights)]
+        termIds = [termId for termId, _ in termWeights if termId is not None]
+        weights = [weight for termId, weight in termWeights if termId is not None]
+        if len(termIds) == 0:
+            return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float64)
+
+        postings = [(self.postingOffsets[t], self.postingOffsets[t + 1]) for t in termIds]
+        candidates = np.unique(np.concatenate([self.postingDocs[start:end] for start, end in postings]))
+        if moods is not None:
+            if self.moods is None:
+                raise Exception("This index has no moods. Moods can only be selected in an index of all songs.")
+            candidates = candidates[(getMoodMask(moods) >> self.moods[candidates]) & 1 == 1]
+        if songMask is not None:
+            candidates = candidates[songMask[self.songIds[candidates]]]
+        filtered = moods is not None or songMask is not None
+        scores = np.zeros(len(candidates), dtype=np.float64)
+
+        # Terms are accumulated in query order (repeated terms count again), like BM25Okapi
+        for termId, weight, (start, end) in zip(termIds, weights, postings):
+            docs = self.postingDocs[start:end]
+            freqs = self.postingFreqs[start:end]
+            positions = np.searchsorted(candidates, docs)
+            if filtered:
+                # Leave out postings of documents filtered out by mood or song
+                matches = positions < len(candidates)
+                matches[matches] = candidates[positions[matches]] == docs[matches]
+                docs, freqs, positions = docs[matches], freqs[matches], positions[matches]
+            termScores = self.idf[termId] * (freqs * (self.k1 + 1) / (freqs + self.docNorms[docs]))
+            if weight != 1:
+                termScores = termScores * weight
+            scores[positions] += termScores
+
+        return candidates, scores
+
+    # Returns (song ids, scores) of the n best documents, best first. Ties are broken by document position.
+    # Documents that contain none of the query terms are not returned, so fewer than n results are possible.
+    # moods limits results to songs of the given moods (indexes of all songs only), and songMask to the
+    # songs where it is True.
+    def getTopN(self, query, n=10, moods=None, weights=None, songMask=None):
+        docIds, scores = self.getScores(query, moods, weights, songMask)
+        if len(docIds) > n:
+            best = np.argpartition(-scores, n - 1)[:n]
+            # argpartition does not keep ties at the cut-off together, so include every tied document
+            threshold = scores[best].min()
+            best = np.flatnonzero(scores >= threshold)
+            docIds, scores = docIds[best], scores[best]
+
+        order = np.lexsort((docIds, -scores))[:n]
+        return self.songIds[docIds[order]], scores[order]
+
+    # Arrays of the index in the layout of the index file: terms sorted, postings in term order
+    def getFileArrays(self):
+        if isinstance(self.vocabulary, SortedVocabulary):
+            vocabulary, oldTermIds = self.vocabulary, np.arange(len(self.vocabulary))
+        else:
+            vocabulary, oldTermIds = SortedVocabulary.fromDict(self.vocabulary)
+
+        postingLengths = np.diff(self.postingOffsets)[oldTermIds]
+        postingOffsets = np.zeros(len(oldTermIds) + 1, dtype=np.int64)
+        postingOffsets[1:] = np.cumsum(postingLengths)
+        # Position in the current postings of every posting, in the new term order
+        positions = np.repeat(self.postingOffsets[oldTermIds] - postingOffsets[:-1], postingLengths) + np.arange(postingOffsets[-1])
+
+        arrays = {
+            'termBytes': vocabulary.termBytes,
+            'termOffsets': vocabulary.termOffsets,
+            'postingOffsets': postingOffsets,
+            'postingDocs': self.postingDocs[positions],
+            'postingFreqs': self.postingFreqs[positions],
+            'docLengths': self.docLengths,
+            'docNorms': self.docNorms,
+            'idf': self.idf[oldTermIds],
+            'songIds': self.songIds
+        }
+        if self.moods is not None:
+            arrays['moods'] = self.moods
+        deleteIndex = self.deleteIndex
+        if deleteIndex is None:
+            deleteIndex = DeleteIndex.build(vocabulary)
+        arrays.update(deleteIndex.getFileArrays())
+        return arrays
+
+# Writes indexes ({name: BM25Index}) to a binary index file. The file is written under a temporary name
+# and then renamed, so processes that have the previous file open keep a consistent view of it. Windows does
+# not allow replacing a file that another process has memory-mapped: a PermissionError is raised then, and the
+# previous file is kept.
+def saveIndexes(path, indexes):
+    header = {'indexes': {}}
+    arrays = []
+    offset = 0
+    for name, index in indexes.items():
+        fileArrays = index.getFileArrays()
+        deleteIndex = index.deleteIndex
+        entry = {'avgdl': index.avgdl, 'k1': index.k1, 'b': index.b, 'epsilon': index.epsilon, 'arrays': {},
+                 'maxEditDistance': maxEditDistance if deleteIndex is None else deleteIndex.maxDistance,
+                 'deletePrefixLength': deletePrefixLength if deleteIndex is None else deleteIndex.prefixLength}
+        for arrayName, array in fileArrays.items():
+            array = np.ascontiguousarray(array, dtype=indexArrays[arrayName])
+            entry['arrays'][arrayName] = [offset, len(array)]
+            arrays.append((offset, array))
+            offset += -(-array.nbytes // arrayAlignment) * arrayAlignment
+        header['indexes'][str(name)] = entry
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    dataStart = -(-(16 + len(headerBytes)) // arrayAlignment) * arrayAlignment
+
+    with open(path + '.tmp', 'wb') as f:
+        f.write(indexMagic)
+        f.write(np.array([indexVersion, len(headerBytes)], dtype='<u4').tobytes())
+        f.write(headerBytes)
+        for arrayOffset, array in arrays:
+            f.seek(dataStart + arrayOffset)
+            f.write(array.tobytes())
+        f.truncate(dataStart + offset)
+    try:
+        os.replace(path + '.tmp', path)
+    except PermissionError as e:
+        # On Windows, a file memory-mapped by a running web application or retrieval server cannot be replaced
+        os.remove(path + '.tmp')
+        raise PermissionError('Cannot replace ' + path + ': it is open in another process. Stop the web application and the retrieval server, '
+                              'then run dataprep.py --reindex to write the index again.') from e
+
+# Opens a binary index file. Returns {name: BM25Index}: {unifiedIndexName: index of all songs} for
+# version 2 files, and {mood: index of the mood} for version 1 files. With mapped, arrays are memory-mapped views of
+# the file; otherwise the file is read into memory (needed to overwrite the same file later on Windows).
+def loadIndexes(path, mapped=True):
+    if mapped:
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        with open(path, 'rb') as f:
+            data = np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+
+    if data[:8].tobytes() != indexMagic:
+        raise Exception("Not a BM25 index file: " + path)
+    version, headerLength = np.frombuffer(data[8:16].tobytes(), dtype='<u4')
+    if version not in supportedIndexVersions:
+        raise Exception("Unsupported index file version " + str(version) + " in " + path + ". Expected version " + str(indexVersion))
+    header = json.loads(data[16:16 + headerLength].tobytes().decode('utf-8'))
+    dataStart = -(-(16 + int(headerLength)) // arrayAlignment) * arrayAlignment
+
+    indexes = {}
+    for name, entry in header['indexes'].items():
+        arrays = {}
+        for arrayName, (offset, length) in entry['arrays'].items():
+            dtype = np.dtype(indexArrays[arrayName])
+            start = dataStart + offset
+            # Plain ndarray views of the mapped file: slicing a memmap is several times slower
+            arrays[arrayName] = data[start:start + length * dtype.itemsize].view(dtype).view(np.ndarray)
+
+        vocabulary = SortedVocabulary(arrays['termBytes'], arrays['termOffsets'])
+        deleteIndex = None
+        if 'deleteBytes' in arrays:
+            deleteIndex = DeleteIndex(SortedVocabulary(arrays['deleteBytes'], arrays['deleteOffsets']), arrays['deleteTermOffsets'],
+                                      arrays['deleteTermIds'], entry['maxEditDistance'], entry['deletePrefixLength'])
+        index = BM25Index(vocabulary, arrays['postingOffsets'], arrays['postingDocs'], arrays['postingFreqs'],
+                          arrays['docLengths'], arrays['idf'], entry['avgdl'], entry['k1'], entry['b'], entry['epsilon'],
+                          arrays['songIds'], arrays['docNorms'], arrays.get('moods'), deleteIndex)
+        indexes[int(name) if name.isdigit() else name] = index
+    return indexes
@@ -0,0 +1,288 @@
+## catalog.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## ARRAY-BACKED SONG CATALOG ADDRESSED BY SONG ID, AND THE STREAMING WRITER THAT PRODUCES IT
+
+import csv
+import hashlib
+import numbers
+import os
+import urllib.parse
+
+import numpy as np
+
+from better_profanity import profanity
+
+# Song metadata (music.csv) and lyrics (lyrics.bin) are stored separately. music.csv is small and holds
+# one row per song; lyrics are UTF-8 text concatenated in lyrics.bin and each row of music.csv has the
+# byte offset and length of its lyrics.
+lyricsColumns = ['lyrics_offset', 'lyrics_length']
+
+# Fields shown for each song in results, derived from its title and artist when the song database is
+# built, so answering a query only needs lookups: title with profanity censored, whether the title has
+# profanity, and the link to the song on the music service. They depend on the profanity wordlist, and
+# can be computed again without the rest of the data preparation (python dataprep.py --refresh-display).
+displayColumns = ['display_title', 'explicit', 'link']
+
+musicServiceURL = 'https://music.youtube.com/search?q='
+
+# Link to search a song on the music service, with the search terms URL-encoded
+def getSongLink(title, artist):
+    return musicServiceURL + urllib.parse.quote_plus(title + ' by ' + artist)
+
+# Returns the display fields of a song: (title with profanity censored, explicit, link)
+def getDisplayFields(title, artist):
+    displayTitle = profanity.censor(title)
+    return displayTitle, displayTitle != title, getSongLink(title, artist)
+
+# Identifies the profanity wordlist in use, so display fields computed with another wordlist are not reused
+def getWordlistSignature():
+    profanity.censor('')    # Loads the default wordlist if none was loaded yet
+    words = sorted(str(word) for word in profanity.CENSOR_WORDSET)
+    return hashlib.sha1('\n'.join(words).encode('utf-8')).hexdigest()
+
+# Strings stored in a single UTF-8 buffer, with the offset of each string in it. Holding a column this way
+# takes the bytes of its text plus 8 bytes per string, instead of a Python object of 50 bytes or more per
+# string. Strings are decoded when they are looked up: column[songId], or column[songIds] for an array of
+# strings.
+class StringColumn:
+    def __init__(self, values):
+        encodedValues = [value.encode('utf-8') for value in values]
+        self.offsets = np.zeros(len(encodedValues) + 1, dtype=np.int64)    # String i is data[offsets[i]:offsets[i + 1]]
+        np.cumsum(np.fromiter((len(value) for value in encodedValues), dtype=np.int64, count=len(encodedValues)), out=self.offsets[1:])
+        self.data = b''.join(encodedValues)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            if key < 0:
+                key += len(self)
+            return self.data[self.offsets[key]:self.offsets[key + 1]].decode('utf-8')
+        return np.array([self[i] for i in np.asarray(key).ravel()], dtype=object)
+
+# Strings that repeat across songs (artists, albums), stored once each: every song has the code of its
+# string in a StringColumn of the distinct strings. Looked up like a StringColumn.
+class InternedColumn:
+    def __init__(self, values):
+        distinctValues, codes = np.unique(np.asarray(values, dtype=object), return_inverse=True)
+        self.codes = codes.astype(np.int32)             # int32[numSongs]
+        self.values = StringColumn(distinctValues)      # Distinct strings, sorted
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, key):
+        if isinstance(key, numbers.Integral):
+            return self.values[int(self.codes[key])]
+        return self.values[self.codes[np.asarray(key)]]
+
+# Song ids sorted by compound score, so the songs of any compound range are a slice found by binary search,
+# instead of a scan of every song. Songs without a compound (e.g. NaN) are left out.
+class CompoundIndex:
+    def __init__(self, compounds):
+        known = np.flatnonzero(~np.isnan(compounds))
+        order = known[np.argsort(compounds[known], kind='stable')]
+        self.songIds = order.astype(np.int32)           # int32[numKnown], song ids by ascending compound
+        self.compounds = compounds[order]               # float64[numKnown], compound of each of them
+
+    # Positions in songIds of the songs with low <= compound <= high
+    def getBounds(self, low, high):
+        return np.searchsorted(self.compounds, low, 'left'), np.searchsorted(self.compounds, high, 'right')
+
+    # Song ids of the songs with low <= compound <= high, by ascending compound
+    def getRange(self, low, high):
+        start, end = self.getBounds(low, high)
+        return self.songIds[start:end]
+
+    # Song ids of the n songs with low <= compound <= high whose compound is closest to target, closest
+    # first. Ties are broken by song id. Only the n songs on each side of target are looked at.
+    def getClosest(self, target, n, low=-1, high=1):
+        start, end = self.getBounds(low, high)
+        center = min(max(np.searchsorted(self.compounds, target), start), end)
+        positions = np.arange(max(start, center - n), min(end, center + n))
+        order = np.lexsort((self.songIds[positions], np.abs(self.compounds[positions] - target)))[:n]
+        return self.songIds[positions[order]]
+
+# Song metadata stored column by column. The song id is the row position of the song in music.csv, so
+# every field of a song is a direct lookup: catalog.titles[songId]. Columns also accept a list or array
+# of song ids to fetch the fields of many songs at once.
+# Text columns are compact (StringColumn, InternedColumn) and lyrics are not held in memory: lyrics.bin is
+# memory-mapped when the catalog is built and lyrics are decoded when asked for (getLyrics), so the memory
+# used by a process grows with the metadata of the songs and not with the size of their lyrics. The mapping
+# keeps the file the offsets were read with, even if lyrics.bin is replaced by a new run of dataprep.py.
+# Song databases written before display fields existed have none: they are computed the first time a
+# song is shown and kept in memory.
+# Song databases written with the compound of each song have it in compounds, with a CompoundIndex to
+# find the songs of a compound range. Older song databases have none (compounds is None).
+class SongCatalog:
+    def __init__(self, titles, artists, albums, sentiments, displayTitles=None, explicit=None, links=None,
+                 lyricsFile=None, lyricsOffsets=None, lyricsLengths=None, compounds=None):
+        self.titles = titles                # StringColumn[numSongs]
+        self.artists = artists              # InternedColumn[numSongs]
+        self.albums = albums                # InternedColumn[numSongs]
+        self.sentiments = sentiments        # int8[numSongs], 1 (very sad) to 5 (very happy)
+        self.displayTitles = displayTitles  # songId -> title with profanity censored, for explicit songs only, or None
+        self.explicit = explicit            # bool[numSongs], True if the title has profanity, or None
+        self.links = links                  # StringColumn[numSongs], link to the song on the music service, or None
+        self.lyricsFile = lyricsFile        # File with the lyrics of all songs (lyrics.bin), or None
+        self.lyricsData = None if lyricsFile is None else mapLyricsFile(lyricsFile)   # uint8 view of the mapped file
+        self.lyricsOffsets = lyricsOffsets  # int64[numSongs], byte offset of the lyrics of each song in lyricsFile
+        self.lyricsLengths = lyricsLengths  # int32[numSongs], byte length of the lyrics of each song
+        self.computedDisplayFields = {}     # songId -> display fields, when the song database has none
+        self.compounds = compounds          # float64[numSongs], VADER compound of each song (-1 to 1), or None
+        self.compoundIndex = None if compounds is None else CompoundIndex(compounds)
+
+    def __len__(self):
+        return len(self.titles)
+
+    # Builds the catalog from the song dataset produced by dataprep.py (music.csv). lyricsFile is the
+    # file with the lyrics of the songs (lyrics.bin). It is memory-mapped, not read.
+    @classmethod
+    def fromDataFrame(cls, songs, lyricsFile=None):
+        titles = StringColumn(songs.title.fillna('').astype(str))
+        artists = InternedColumn(songs.artist.fillna('').astype(str))
+        # music.csv files written before the album column was added have no album information
+        if 'album' in songs.columns:
+            albums = InternedColumn(songs.album.fillna('').astype(str))
+        else:
+            albums = InternedColumn([''] * len(songs))
+        sentiments = songs.sentiment.to_numpy(dtype=np.int8)
+        compounds = songs.compound.to_numpy(dtype=np.float64) if 'compound' in songs.columns else None
+
+        displayTitles, explicit, links = None, None, None
+        if all(column in songs.columns for column in displayColumns):
+            explicit = songs.explicit.fillna(False).to_numpy(dtype=bool)
+            displayTitles = dict(zip(np.flatnonzero(explicit).tolist(), songs.display_title[explicit].fillna('').astype(str)))
+            links = StringColumn(songs.link.fillna('').astype(str))
+
+        # music.csv files written before lyrics were stored separately have lyrics in a column, which is not kept
+        lyricsOffsets, lyricsLengths = None, None
+        if lyricsFile is not None and os.path.isfile(lyricsFile) and all(column in songs.columns for column in lyricsColumns):
+            lyricsOffsets = songs.lyrics_offset.to_numpy(dtype=np.int64)
+            lyricsLengths = songs.lyrics_length.to_numpy(dtype=np.int32)
+        else:
+            lyricsFile = None
+        return cls(titles, artists, albums, sentiments, displayTitles, explicit, links, lyricsFile, lyricsOffsets, lyricsLengths, compounds)
+
+    # Song ids of all songs with the given sentiment, in catalog order
+    def getSongIds(self, sentiment):
+        return np.flatnonzero(self.sentiments == sentiment)
+
+    # Returns (title with profanity censored, explicit, link) of a song
+    def getDisplayFields(self, songId):
+        if self.explicit is not None:
+            explicit = bool(self.explicit[songId])
+            return self.displayTitles[int(songId)] if explicit else self.titles[songId], explicit, self.links[songId]
+
+        displayFields = self.computedDisplayFields.get(songId)
+        if displayFields is None:
+            displayFields = getDisplayFields(self.titles[songId], self.artists[songId])
+            self.computedDisplayFields[songId] = displayFields
+        return displayFields
+
+    # Returns the compound of a song, or None if it is not known
+    def getCompound(self, songId):
+        if self.compounds is None or np.isnan(self.compounds[songId]):
+            return None
+        return float(self.compounds[songId])
+
+    # Reads the lyrics of a song from the lyrics file. Returns None if the song database has no lyrics file.
+    def getLyrics(self, songId):
+        if self.lyricsData is None:
+            return None
+        offset = int(self.lyricsOffsets[songId])
+        return self.lyricsData[offset:offset + int(self.lyricsLengths[songId])].tobytes().decode('utf-8')
+
+    # Returns all fields of a song as a dictionary. Lyrics are not included: see getLyrics().
+    def getSong(self, songId):
+        displayTitle, explicit, link = self.getDisplayFields(songId)
+        return {
+            'id': int(songId),
+            'title': self.titles[songId],
+            'artist': self.artists[songId],
+            'album': self.albums[songId],
+            'sentiment': int(self.sentiments[songId]),
+            'compound': self.getCompound(songId),
+            'displayTitle': displayTitle,
+            'explicit': explicit,
+            'link': link
+        }
+
+# Memory-maps a lyrics file. Returns a plain ndarray view of the mapping (slicing a memmap is slower).
+# An empty file cannot be mapped: it has no lyrics to read anyway.
+def mapLyricsFile(lyricsFile):
+    if os.path.getsize(lyricsFile) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(lyricsFile, dtype=np.uint8, mode='r').view(np.ndarray)
+
+# Returns the lyrics of every song of a music.csv DataFrame, in row order. Reads lyrics.bin, or the
+# lyrics column of music.csv files written before lyrics were stored separately.
+def loadLyrics(songs, lyricsFile):
+    if 'lyrics' in songs.columns:
+        return songs.lyrics.fillna('').astype(str).tolist()
+
+    with open(lyricsFile, 'rb') as lf:
+        lyricsData = lf.read()
+    return [lyricsData[offset:offset + length].decode('utf-8') for offset, length in zip(songs.lyrics_offset, songs.lyrics_length)]
+
+# Writes the song database as songs are categorized, instead of growing a DataFrame in memory.
+# Rows are buffered and written in chunks of chunkSize songs, so memory use does not depend on the
+# number of songs. Output goes to <file>.partial files, which are complete up to the last written chunk
+# and can be read if a run is interrupted; close() renames them to their final names.
+class CatalogWriter:
+    def __init__(self, songFile, lyricsFile, columns, chunkSize=1000):
+        self.songFile = songFile
+        self.lyricsFile = lyricsFile
+        self.columns = columns
+        self.chunkSize = chunkSize
+        self.songCount = 0
+        self.lyricsOffset = 0
+        self.pendingRows = []
+        self.pendingLyrics = []
+
+        self.songHandle = open(songFile + '.partial', 'w', encoding='utf-8', newline='')
+        self.lyricsHandle = open(lyricsFile + '.partial', 'wb')
+        self.songWriter = csv.writer(self.songHandle, lineterminator='\n')
+        # The first (unnamed) column is the song id, as in files written by DataFrame.to_csv
+        self.songWriter.writerow([''] + columns + lyricsColumns)
+
+    # Adds a song. values has one value per column given to the constructor.
+    def addSong(self, values, lyrics):
+        encodedLyrics = lyrics.encode('utf-8')
+        self.pendingRows.append([self.songCount] + list(values) + [self.lyricsOffset, len(encodedLyrics)])
+        self.pendingLyrics.append(encodedLyrics)
+        self.lyricsOffset += len(encodedLyrics)
+        self.songCount += 1
+
+        if len(self.pendingRows) >= self.chunkSize:
+            self.flush()
+
+    # Writes buffered songs. Lyrics are written first, so every row in music.csv points to lyrics on disk.
+    def flush(self):
+        self.lyricsHandle.write(b''.join(self.pendingLyrics))
+        self.lyricsHandle.flush()
+        self.songWriter.writerows(self.pendingRows)
+        self.songHandle.flush()
+        self.pendingRows = []
+        self.pendingLyrics = []
+
+    # Writes remaining songs and replaces the previous song database with the new one. On Windows, lyrics.bin
+    # cannot be replaced while a web application or retrieval server has it memory-mapped: a PermissionError
+    # is raised then, and the previous song database and the new partial files are kept.
+    def close(self):
+        self.flush()
+        self.songHandle.close()
+        self.lyricsHandle.close()
+        try:
+            os.replace(self.lyricsFile + '.partial', self.lyricsFile)
+        except PermissionError as e:
+            raise PermissionError('Cannot replace ' + self.lyricsFile + ': it is open in another process. Stop the web application and the '
+                                  'retrieval server, then run dataprep.py again.') from e
+        os.replace(self.songFile + '.partial', self.songFile)
+
+    # Stops writing, keeping the partial files for inspection
+    def abort(self):
+        self.flush()
+        self.songHandle.close()
+        self.lyricsHandle.close()
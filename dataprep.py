@@ -2,33 +2,54 @@
 ## Authors: Gunther Bacellar and Pericles Rocha
 ## SCRIPT TO ANALYZE THE LYRICS DB AND CATEGORIZE SONGS
 
+import csv
+import hashlib
+import json
+import multiprocessing
 import nltk
 import numpy as np
 import os
 import pandas as pd
-import pickle
-import spacy
 import sys
 import time
 
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-from rank_bm25 import BM25Okapi
-from textblob import TextBlob   #Required for language detection
-
-# Determine arguments passed to the script. The script accepts only ONE argument: scope
-# Accepted values: 'full','verse','line'
-# If no parameters are passed, we will use 'verse' as the default.
-# If the argument is invalid, we will halt execution. 
-acceptedArgs = ['full','verse','line']
-scope = 'verse' #Default
+from bm25index import BM25Index, loadIndexes, saveIndexes, unifiedIndexName
+from catalog import CatalogWriter, displayColumns, getDisplayFields, getSongLink, getWordlistSignature, loadLyrics
+from ingest import SongSource
+from language import getIdentifier
+from metrics import RunMetrics, SongTimer, formatDuration
+from sentiment import acceptedScopes, getScorer
+from tokenization import TokenCache, getDocumentText, getTextHash, getTokenizerSignature, loadTokenizer, saveTokenCache, tokenCacheFile, tokenizeTexts
 
 songFile  = 'music.csv'
-indexFile = 'bm25.pkl'
+lyricsFile = 'lyrics.bin'
+indexFile = 'bm25.idx'  # Binary index file, memory-mapped by the web application
+manifestFile = 'manifest.json'  # Content hash and outcome of every song file, used by incremental runs
+
+# Language detectors: 'local' uses the character n-gram profiles shipped in language_profiles.json and
+# runs offline; 'textblob' uses TextBlob, which calls an online translation service for every song.
+acceptedLanguageDetectors = ['local', 'textblob']
+
+# NLTK packages required for tokenization, stopwords, and sentiment analysis, and where NLTK stores them
+nltkPackages = {'punkt': 'tokenizers/punkt', 'stopwords': 'corpora/stopwords', 'vader_lexicon': 'sentiment/vader_lexicon.zip'}
+
+# Song outcome fields kept in the manifest for each song file
+manifestFields = ['status', 'language', 'compound', 'sentiment', 'scopeCompounds', 'displayTitle', 'explicit']
+
+# Manifest fields that depend on the profanity wordlist
+displayFields = ['displayTitle', 'explicit']
+
+# Compound scores that separate the sentiment categories (see getSentimentCategory). Songs can be
+# categorized again with other thresholds from the compound stored in music.csv (--rebucket), and the
+# thresholds in use are kept in the manifest.
+sentimentThresholds = [-0.6, -0.2, 0.2, 0.6]
 
-if (len(sys.argv)) > 1: # If parameters passed, see if it is accepted
-    scope = sys.argv[1].lower()
-    if scope not in acceptedArgs:
-        raise Exception("Invalid value for scope argument. Accepted: 'full', 'verse' or 'line'. Provided: ", scope)
+# Keys of songsByCategory for each sentiment category (1 to 5)
+categoryNames = ['1_very_bad', '2_bad', '3_neutral', '4_good', '5_very_good']
+
+# Decodes the content of a song file. Line endings are normalized as reading in text mode would do.
+def decodeLyrics(rawBytes):
+    return rawBytes.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n').strip()
 
 # Removes metadata written in the bottom of song files. Metadata starts after a line with a series of underscores ("___...")
 def removeLyricMetadata(lyrics):
@@ -55,93 +76,382 @@ def removeStopWords(lyrics):
     return newLyrics
 
 # Detects the language of the written lyrics
-def detectLanguage(lyrics):
-    songLanguage = TextBlob(lyrics)
-    return songLanguage.detect_language()
-
-# Measures the sentiment for each line in the lyrics and computes an average for the whole song
-def getAverageCompound(lyrics, scope='full', addTitle=True, title=''):
-    compounds = []
-    
-    if addTitle:
-        lyrics = title + '\n' + '\n' + lyrics
-
-    #Get the sentiment from the FULL lyrics at once
-    if scope == 'full':
-        sentiment = SentimentIntensityAnalyzer()
-        compounds.append(sentiment.polarity_scores(lyrics)['compound'])
-
-    #Get the sentiment from the average of the compounds of each verse
-    elif scope == 'verse':
-        linecounter = 0
-        paragraph = ''
-        for line in lyrics.splitlines():
-            if line.strip() == '':
-                if linecounter > 0: 
-                    #Compute the sentiment for a full verse in the lyrics
-                    sentiment = SentimentIntensityAnalyzer()
-                    verseCompound = sentiment.polarity_scores(paragraph)['compound']
-                    if verseCompound != 0:
-                        compounds.append(verseCompound)
-                    linecounter = 0
-                    paragraph = ''
-            else:
-                paragraph = paragraph + line + '\n'
-                linecounter += 1
-
-    #Get the sentiment from the average of the compounds of each line
-    elif scope == 'line':
-        for line in lyrics.splitlines():
-            if len(line.strip()) > 0:
-                sentiment = SentimentIntensityAnalyzer()
-                compounds.append(sentiment.polarity_scores(line)['compound'])
-
-    meanCompound = 0
-    if len(compounds) > 0:     
-        meanCompound = np.mean(compounds)
-
-    return meanCompound
-
-def createIndexes():
+def detectLanguage(lyrics, detector='local'):
+    if detector == 'textblob':
+        from textblob import TextBlob   # Only required for online language detection
+        songLanguage = TextBlob(lyrics)
+        return songLanguage.detect_language()
+
+    return getIdentifier().detectLanguage(lyrics)
+
+# Categorizes the song lyrics with a sentiment 1 to 5 based on the compound score. With the default thresholds:
+# 1 Very bad    : compound  < -0.6
+# 2 Bad         : compound >= -0.6 and < -0.2
+# 3 Neutral     : compound >= -0.2 and <= 0.2
+# 4 Good        : compound  >  0.2 and <= 0.6
+# 5 Very Good   : compound  >  0.6
+# A compound that is not a number (e.g. missing) gets sentiment 0.
+def getSentimentCategory(compound, thresholds=sentimentThresholds):
+    veryBad, bad, good, veryGood = thresholds
+    sentiment = 0
+    if (compound < veryBad):
+        sentiment = 1
+    elif (compound >= veryBad) and (compound < bad):
+        sentiment = 2
+    elif (compound >= bad) and (compound <= good):
+        sentiment = 3
+    elif (compound > good) and (compound <= veryGood):
+        sentiment = 4
+    elif (compound > veryGood):
+        sentiment = 5
+    return sentiment
+
+# Performs all the work for a single song file: reads it, removes metadata, checks length and language,
+# and computes its sentiment. Runs in worker processes when categorizeSongs() is called with workers > 1,
+# so it only depends on its arguments and returns everything the caller needs as a dictionary.
+# status is one of 'success', 'short', 'nonEnglish' or 'failed'.
+# With compareScopes, the compound for every scope is also returned in 'scopeCompounds'. All scopes are
+# scored in a single scoreLyrics() call.
+# cachedSong is the manifest entry of this file from a previous run. If the file content did not change,
+# its outcome is reused and the language detection and sentiment analysis are skipped.
+# languageDetector selects how languages are detected ('local' or 'textblob').
+# The time spent on each stage is returned in 'timings' ({stage: (seconds, bytes processed)}).
+# content is the content of the file, when it was already read (see SongSource.readSongs()), or the
+# exception raised reading it. Otherwise the file is read here.
+# thresholds are the compound scores that separate sentiment categories. Sentiments of cached songs are
+# computed again from their compound, so they follow the thresholds of the current run.
+def analyzeSong(songPath, song, artist, album, scope, compareScopes=False, cachedSong=None, languageDetector='local', content=None, thresholds=sentimentThresholds):
+    result = {'path': songPath, 'title': song, 'artist': artist, 'album': album, 'status': 'success'}
+    timer = SongTimer()
+    try:
+        # Read the lyrics file. Line endings are normalized as reading in text mode would do.
+        if isinstance(content, Exception):
+            raise content
+        if content is None:
+            with open(songPath, 'rb') as songFileHandle:
+                rawBytes = songFileHandle.read()
+        else:
+            rawBytes = content
+        result['hash'] = hashlib.sha1(rawBytes).hexdigest()
+        rawLyrics = decodeLyrics(rawBytes)
+        timer.lap('readFile' if content is None else 'decodeFile', len(rawBytes))
+        
+        # Remove metadata before I categorize the song
+        lyrics = removeLyricMetadata(rawLyrics)
+        lyricsBytes = len(lyrics.encode('utf-8'))
+        timer.lap('removeLyricMetadata', len(rawBytes))
+
+        if isCachedSongValid(cachedSong, result['hash'], compareScopes):
+            for field in manifestFields:
+                if field in cachedSong:
+                    result[field] = cachedSong[field]
+            if result['status'] == 'success':
+                result['lyrics'] = lyrics
+                result['sentiment'] = getSentimentCategory(result['compound'], thresholds)
+                if 'displayTitle' not in result:
+                    result['displayTitle'], result['explicit'], _ = getDisplayFields(song, artist)
+                    timer.lap('getDisplayFields', len(song.encode('utf-8')))
+            result['cached'] = True
+            return result
+
+        # For some reason, some lyrics are empty. 
+        # Songs on our database need to have at least 24 words after removing the metadata
+        if len(lyrics.split()) < 24:
+            result['status'] = 'short'
+            return result
+
+        # Perform analysis ONLY if lyrics are in English
+        songLanguage = detectLanguage(lyrics, languageDetector)
+        timer.lap('detectLanguage', lyricsBytes)
+        if songLanguage != 'en':
+            result['status'] = 'nonEnglish'
+            result['language'] = songLanguage
+            return result
+
+        # Remove stop words - EVALUATE IF THIS YELD BETTER RESULTS OR NOT
+        lyricsNoStopWords = removeStopWords(lyrics)
+        timer.lap('removeStopWords', lyricsBytes)
+
+        # Get the compound sentiment. Can be full lyrics, verse or line averages
+        # The song title is added to the analysis, followed by an empty line
+        scopeCompounds = getScorer().scoreLyrics(song + '\n' + '\n' + lyricsNoStopWords, acceptedScopes if compareScopes else [scope])
+        compound = scopeCompounds[scope]
+        if compareScopes:
+            result['scopeCompounds'] = scopeCompounds
+        timer.lap('scoreLyrics', len(lyricsNoStopWords.encode('utf-8')))
+
+        # Title with profanity censored, so the web application does not censor titles on every query
+        result['displayTitle'], result['explicit'], _ = getDisplayFields(song, artist)
+        timer.lap('getDisplayFields', len(song.encode('utf-8')))
+
+        result['lyrics'] = lyrics
+        result['compound'] = compound
+        result['sentiment'] = getSentimentCategory(compound, thresholds)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    finally:
+        result['timings'] = timer.getTimings()
+
+    return result
+
+# Determines if the outcome of a song from a previous run can be reused for the current file content.
+# Failures are never reused, as they may have been caused by a temporary problem.
+def isCachedSongValid(cachedSong, contentHash, compareScopes):
+    if cachedSong is None or cachedSong['hash'] != contentHash or cachedSong['status'] == 'failed':
+        return False
+    if compareScopes and cachedSong['status'] == 'success' and 'scopeCompounds' not in cachedSong:
+        return False
+    return True
+
+# Key of a song file in the manifest. Uses '/' so manifests can be shared across operating systems.
+def getManifestKey(songPath):
+    return songPath.replace(os.sep, '/')
+
+# Reads the manifest written by the previous run. Returns an empty manifest if there is none, or if it
+# was produced with a different scope or language detector (all songs need to be analyzed again in that case).
+# Display fields are dropped if they were computed with another profanity wordlist.
+def loadManifest(scope, languageDetector='local'):
+    try:
+        with open(manifestFile, 'r', encoding='utf-8') as mf:
+            manifest = json.load(mf)
+    except FileNotFoundError:
+        return {}
+    if manifest.get('scope') != scope:
+        print('Manifest was produced with scope', str(manifest.get('scope')).upper() + '. All songs will be analyzed.')
+        return {}
+    if manifest.get('languageDetector', 'textblob') != languageDetector:
+        print('Manifest was produced with language detector', str(manifest.get('languageDetector', 'textblob')) + '. All songs will be analyzed.')
+        return {}
+    if manifest.get('wordlist') != getWordlistSignature():
+        for cachedSong in manifest['songs'].values():
+            for field in displayFields:
+                cachedSong.pop(field, None)
+    return manifest['songs']
+
+def saveManifest(scope, songs, languageDetector='local', thresholds=sentimentThresholds):
+    with open(manifestFile, 'w', encoding='utf-8') as mf:
+        json.dump({'version': 1, 'scope': scope, 'languageDetector': languageDetector, 'wordlist': getWordlistSignature(),
+                   'thresholds': list(thresholds), 'songs': songs}, mf)
+
+# Returns the sentiment thresholds of the previous run or --rebucket, kept in the manifest, or the default ones
+def loadThresholds():
+    try:
+        with open(manifestFile, 'r', encoding='utf-8') as mf:
+            return json.load(mf).get('thresholds', sentimentThresholds)
+    except FileNotFoundError:
+        return sentimentThresholds
+
+# Computes the display fields of a list of (title, artist). Runs in worker processes with --workers.
+def getDisplayFieldsTask(songs):
+    return [getDisplayFields(title, artist) for title, artist in songs]
+
+# Computes the display fields (censored title, explicit flag and link) of every song in the song database
+# again, e.g. after the profanity wordlist changed, without analyzing songs or creating indexes again.
+# Song ids, lyrics and indexes do not change. The manifest does not need to change either: display fields
+# computed with another wordlist are not reused by incremental runs.
+def refreshDisplayFields(workers=1):
+    print('Refreshing display fields of', songFile + '...')
+    startTime = time.time()
+    # Read as text, so every other column is written back exactly as it was
+    songs = pd.read_csv(songFile, dtype=str, keep_default_na=False)
+    pairs = list(zip(songs.title, songs.artist))
+
+    chunkSize = max(1, min(1000, len(pairs) // (workers * 4)))
+    chunks = [pairs[start:start + chunkSize] for start in range(0, len(pairs), chunkSize)]
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            chunkResults = pool.map(getDisplayFieldsTask, chunks)
+    else:
+        chunkResults = map(getDisplayFieldsTask, chunks)
+    fields = [songFields for chunkFields in chunkResults for songFields in chunkFields]
+
+    songs['display_title'] = [displayTitle for displayTitle, _, _ in fields]
+    songs['explicit'] = [explicit for _, explicit, _ in fields]
+    songs['link'] = [link for _, _, link in fields]
+    rewriteSongDatabase(songs)
+
+    print('Display fields of', str(len(songs)), 'songs refreshed in', str(round(time.time() - startTime, 2)), 'seconds.', str(sum(explicit for _, explicit, _ in fields)), 'songs have explicit titles.')
+
+# Writes back a song database read as text (dtype=str), replacing music.csv only once it is complete
+def rewriteSongDatabase(songs):
+    with open(songFile + '.partial', 'w', encoding='utf-8', newline='') as sf:
+        songWriter = csv.writer(sf, lineterminator='\n')
+        songWriter.writerow(['' if column.startswith('Unnamed:') else column for column in songs.columns])
+        songWriter.writerows(songs.itertuples(index=False, name=None))
+    os.replace(songFile + '.partial', songFile)
+
+# Categorizes every song of the song database again with other thresholds, from the compound stored in
+# music.csv, without analyzing any song. Updates the sentiment of each song in music.csv and in the
+# manifest, and the mood of each song in the index (postings do not change, so the index is not rebuilt).
+def rebucketSongs(thresholds):
+    print('Categorizing songs of', songFile, 'again with thresholds', ', '.join(str(threshold) for threshold in thresholds) + '...')
+    startTime = time.time()
+    songs = pd.read_csv(songFile, dtype=str, keep_default_na=False)
+    if 'compound' not in songs.columns:
+        raise Exception(songFile + " has no compound scores. Run python dataprep.py once to store them.")
+    compounds = pd.to_numeric(songs.compound, errors='coerce').to_numpy(dtype=np.float64)
+    sentiments = np.array([getSentimentCategory(compound, thresholds) for compound in compounds], dtype=np.int8)
+    songs['sentiment'] = [str(sentiment) for sentiment in sentiments]
+    rewriteSongDatabase(songs)
+
+    # Incremental runs take the sentiment of unchanged songs from the manifest: keep it consistent
+    if os.path.isfile(manifestFile):
+        with open(manifestFile, 'r', encoding='utf-8') as mf:
+            manifest = json.load(mf)
+        for cachedSong in manifest['songs'].values():
+            if cachedSong['status'] == 'success' and 'compound' in cachedSong:
+                cachedSong['sentiment'] = getSentimentCategory(cachedSong['compound'], thresholds)
+        manifest['thresholds'] = list(thresholds)
+        with open(manifestFile, 'w', encoding='utf-8') as mf:
+            json.dump(manifest, mf)
+
+    indexes = loadIndexes(indexFile, mapped=False) if os.path.isfile(indexFile) else {}
+    if unifiedIndexName in indexes:
+        index = indexes[unifiedIndexName]
+        index.moods = sentiments[index.songIds]
+        saveIndexes(indexFile, {unifiedIndexName: index})
+        print('Moods of', str(index.corpusSize), 'songs updated in', indexFile)
+    else:
+        # Index files with one index per mood need to be created again
+        createIndexes()
+
+    for sentiment in range(1, 6):
+        print('           ' + str(sentiment) + '-' + categoryNames[sentiment - 1][2:].replace('_', ' ').title() + ':', str(int(np.sum(sentiments == sentiment))))
+    print(str(len(songs)), 'songs categorized again in', str(round(time.time() - startTime, 2)), 'seconds.')
+
+# Makes sure the NLTK packages are available, downloading only the ones that are missing, so the
+# script also runs without internet access once the packages are installed. Returns False on failure.
+def ensureNltkPackages():
+    for package, resource in nltkPackages.items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            if not nltk.download(package, quiet=True):
+                return False
+    return True
+
+# Lists the (path, content hash) of the songs of each sentiment, in song database order. Songs of a
+# sentiment are only indexed again when this list changes.
+def getSongsBySentiment(manifestSongs):
+    songsBySentiment = {i: [] for i in range(1,6)}
+    for key, cachedSong in manifestSongs.items():
+        if cachedSong['status'] == 'success' and cachedSong['sentiment'] in songsBySentiment:
+            songsBySentiment[cachedSong['sentiment']].append((key, cachedSong['hash']))
+    return songsBySentiment
+
+# Unpacks a task tuple for analyzeSong(). Pool.imap passes a single argument to the function it maps.
+def analyzeSongTask(task):
+    return analyzeSong(*task)
+
+# Creates the inverted index of all songs, with the sentiment of each song so queries can be limited to
+# any set of sentiments. idf is computed over all songs, so any song change requires a new index. If
+# changedSentiments is given (incremental runs) and is empty, the existing index file is kept.
+# Time spent on each step is added to metrics, and the run report is written again if it has one.
+def createIndexes(changedSentiments=None, metrics=None, workers=1, k1=1.5, b=0.75):
     print('')
     print('Creating indexes for text retrieval...')
+    if metrics is None:
+        metrics = RunMetrics()
+    startTime = time.time()
 
     try:
         # read music dataset
-        df = pd.read_csv(songFile)
-        nlp = spacy.load("en_core_web_sm")
-        bm25 = {}
-        # generate the dictionary with 5 different inverted indexes
-        for i in range(1,6):
-            df_tmp = df[df.sentiment== i].copy()
-            df_tmp['lyrics'] = df_tmp['title'] + '\n' + df_tmp['lyrics']
-            tok_text=[] # for our tokenised corpus
-            for doc in nlp.pipe(df_tmp.lyrics.str.lower().values, disable=["tagger", "ner", "lemmatizer"]):
-                tok = [t.text for t in doc if t.is_alpha]
-                tok_text.append(tok)
-            bm25[i] = BM25Okapi(tok_text)
-
-        # save the dictionary with inverted indexes
-        with open(indexFile, 'wb') as tf:
-            pickle.dump(bm25,tf)
-
+        with metrics.measure('readSongDatabase', os.path.getsize(songFile)):
+            df = pd.read_csv(songFile)
+
+        reuseIndex = False
+        if changedSentiments is not None and len(changedSentiments) == 0 and os.path.isfile(indexFile):
+            # Songs did not change since the index was created: music.csv has the same songs, in the same order
+            with metrics.measure('loadIndexes', os.path.getsize(indexFile)):
+                previousIndex = loadIndexes(indexFile).get(unifiedIndexName)
+            # Index files written before version 3 have no delete index: they are rebuilt to add it
+            reuseIndex = previousIndex is not None and previousIndex.corpusSize == len(df) and previousIndex.deleteIndex is not None \
+                and previousIndex.k1 == k1 and previousIndex.b == b
+            previousIndex = None    # Closes the mapped file
+
+        if reuseIndex:
+            print('Reusing index of all songs (no song changes).')
+        else:
+            with metrics.measure('loadLyrics', os.path.getsize(lyricsFile) if os.path.isfile(lyricsFile) else 0):
+                lyrics = loadLyrics(df, lyricsFile)
+            # Every song is tokenized once for the index of all songs. Songs tokenized by a previous index
+            # build are taken from the token cache, by hash of their text.
+            signature = getTokenizerSignature()
+            with metrics.measure('loadTokenCache', os.path.getsize(tokenCacheFile) if os.path.isfile(tokenCacheFile) else 0):
+                tokenCache = TokenCache.load(tokenCacheFile, signature)
+            texts = [getDocumentText(title, songLyrics) for title, songLyrics in zip(df.title.values, lyrics)]
+            lyrics = None
+            hashes = [getTextHash(text) for text in texts]
+            tok_text = [tokenCache.get(textHash) for textHash in hashes] # for our tokenised corpus
+            cachedTexts = len(tokenCache)
+            tokenCache = None
+
+            # Songs with the same text (e.g. the same song in two albums) are tokenized once
+            pending = {}
+            for docId, tokens in enumerate(tok_text):
+                if tokens is None:
+                    pending.setdefault(hashes[docId], []).append(docId)
+            cachedSongs = len(texts) - sum(len(docIds) for docIds in pending.values())
+            print(str(cachedSongs), 'songs tokenized from', tokenCacheFile + ',', str(len(pending)), 'songs to tokenize.')
+            metrics.info['tokenCache'] = {'cachedSongs': cachedSongs, 'tokenizedSongs': len(pending)}
+            if len(pending) > 0:
+                with metrics.measure('loadSpacy'):
+                    nlp = loadTokenizer()
+                pendingTexts = [texts[docIds[0]] for docIds in pending.values()]
+                with metrics.measure('tokenize', sum(len(text) for text in pendingTexts), len(pendingTexts)):
+                    for docIds, tokens in zip(pending.values(), tokenizeTexts(nlp, pendingTexts, workers)):
+                        for docId in docIds:
+                            tok_text[docId] = tokens
+                pendingTexts = None
+            texts = None
+
+            # Song ids are the row positions in music.csv, so results can be looked up in the catalog
+            bm25 = {}
+            with metrics.measure('buildIndex'):
+                bm25[unifiedIndexName] = BM25Index.build(tok_text, k1, b, songIds=df.index.values, moods=df.sentiment.values)
+
+            # save the inverted index
+            saveStart = time.perf_counter()
+            saveIndexes(indexFile, bm25)
+            metrics.record('saveIndexes', time.perf_counter() - saveStart, os.path.getsize(indexFile))
+
+            # Keep the tokens of the indexed songs for the next index build. Songs no longer in music.csv are
+            # dropped from the cache, so it does not grow with every change.
+            uniqueHashes = {}
+            for docId, textHash in enumerate(hashes):
+                uniqueHashes.setdefault(textHash, docId)
+            if len(pending) > 0 or cachedTexts != len(uniqueHashes):
+                with metrics.measure('saveTokenCache'):
+                    saveTokenCache(tokenCacheFile, signature, list(uniqueHashes), [tok_text[docId] for docId in uniqueHashes.values()])
         print('Indexes created successfully.')
     except Exception as e:
         print('Failure on createIndexes()')
         print(e)
 
-def categorizeSongs(scope):
+    metrics.info['indexSeconds'] = round(time.time() - startTime, 3)
+    try:
+        metrics.save()
+    except Exception as e:
+        print('Failed to write run report. Exception:', str(e))
+
+# Categorizes all songs of the database. With incremental, only songs added or changed since the previous
+# run are analyzed; the outcome of the others is taken from the manifest.
+# thresholds are the compound scores that separate sentiments (see getSentimentCategory). If not given,
+# the thresholds of the previous run are used. The compound of every song is written to music.csv.
+# Returns the sentiments whose songs changed since the previous run, or None if not incremental (the
+# index is then always rebuilt).
+# Time spent on each stage is added to metrics, and written as a JSON run report next to the log file.
+def categorizeSongs(scope, workers=1, compareScopes=False, incremental=False, languageDetector='local', metrics=None, source='database_source', thresholds=None):
     print('Attempting to download required package files...')
 
     # Packages required for tokenization, stopwords, and sentiment analysis
-    if (not (nltk.download('punkt', quiet=True))) or (not (nltk.download('stopwords', quiet=True))) or (not nltk.download('vader_lexicon', quiet=True)):
+    if not ensureNltkPackages():
         print('Failed to download required packages. Please verify your internet connection and try again.')
-        return
+        return None
     else: 
         print('Successfully downloaded required package files.')
 
-    dbDir = 'database_source'           # Root directory of the source (original) database
-
     successesCount = 0          # Songs succesfully categorized
     failedSongsCount = 0        # Songs failed to categorized
     failedSongs = []            # List of songs that failed to categorize
@@ -169,9 +479,6 @@ def categorizeSongs(scope):
     if len(seconds) == 1:
         seconds = '0' + seconds
 
-    # Holds the dataframe that stores the sentiment for each song
-    songData = pd.DataFrame(columns = ['title', 'artist', 'lyrics', 'sentiment'])
-    
     # Holds the count of songs categorized in each category
     songsByCategory = {
         '1_very_bad': 0,
@@ -182,115 +489,123 @@ def categorizeSongs(scope):
     }
 
     print('')
-    print('Starting Song Sentiment Analysis on directory', os.path.join(os.path.curdir, dbDir), ' at ' + hour + ':' + minutes + ':' + seconds  + ' on ' + month  + '/' + day + '/' + year, 'with scope',scope.upper())
-    # Count all files for logging purposes
-    print('Counting songs in source directories...')
-    fileCount = sum(len(files) for _, _, files in os.walk(dbDir))
+    print('Starting Song Sentiment Analysis on', 'archive' if os.path.isfile(source) else 'directory', os.path.join(os.path.curdir, source), ' at ' + hour + ':' + minutes + ':' + seconds  + ' on ' + month  + '/' + day + '/' + year, 'with scope',scope.upper())
+    # List all song files once: the count is used for logging purposes, and the list for reading them
+    print('Listing songs in source...')
+    if metrics is None:
+        metrics = RunMetrics()
+    with metrics.measure('listSongFiles'):
+        songSource = SongSource(source)
+    fileCount = len(songSource)
     print('Songs detected:', str(fileCount))
     print('')
 
+    # Outcome of each song file in the previous run, used to skip songs that did not change
+    previousSongs = loadManifest(scope, languageDetector) if incremental else {}
+    # Compound scores that separate sentiments: those of the previous run, unless others are given
+    if thresholds is None:
+        thresholds = loadThresholds()
+    manifestSongs = {}
+    reusedSongsCount = 0
+    languageDetectionCount = 0      # Songs whose language was detected in this run
+    languageDetectionTime = 0       # Seconds spent detecting languages (summed across worker processes)
+
+    # Writes the sentiment for each song to the song database as songs are categorized. Its partial files
+    # are only created once the song source was opened, so an invalid source leaves none behind.
+    songColumns = ['title', 'artist', 'album', 'sentiment', 'compound'] + displayColumns
+    if compareScopes:
+        # Compound of the song in every scope, to compare scopes without running the script once per scope
+        songColumns += ['compound_' + otherScope for otherScope in acceptedScopes]
+    try:
+        songData = CatalogWriter(songFile, lyricsFile, songColumns)
+    except BaseException:
+        songSource.close()
+        raise
+
     # Let's see the sentiment for all lyrics on our DB: 
+    # Songs are analyzed one by one, or fanned out to a pool of worker processes. Either way, results
+    # are collected in directory order, so counters, lists and the log file are the same as a serial run.
+    # Song files are read by a background thread a bounded number of files ahead, so reading (or
+    # decompressing an archive) overlaps with the analysis, and are passed to analyzeSong() with the task.
     startTime = time.time()
-    for letter in sorted(os.listdir(dbDir)):
-        # For each letter...
-        letterPath = os.path.join(dbDir, letter)
-        if os.path.isdir(letterPath):
-            letters = sorted(os.listdir(letterPath), key=str.lower)
-            # ... iterate through artists... 
-            for artist in letters:
-                artistPath = os.path.join(letterPath, artist)
-                if os.path.isdir(artistPath):
-                    albums = sorted(os.listdir(artistPath), key=str.lower)
-                    # .. then through albums... 
-                    for album in albums:
-                        albumPath = os.path.join(artistPath, album)
-                        if os.path.isdir(albumPath):
-                            songs = sorted(os.listdir(albumPath), key=str.lower)
-                            # ... and then each song inside an album.
-                            for song in songs:
-                                songPath = os.path.join(albumPath, song)
-                                if os.path.isfile(songPath): # Is this a file or a directory?
-                                    try:
-                                        # Read the lyrics file
-                                        rawLyrics = open(songPath, 'r', encoding='utf-8').read().strip()
-                                        
-                                        # Remove metadata before I categorize the song
-                                        lyrics = removeLyricMetadata(rawLyrics)
-
-                                        # For some reason, some lyrics are empty. 
-                                        # Songs on our database need to have at least 24 words after removing the metadata
-                                        if len(lyrics.split()) < 24:
-                                            shortLyricsCount += 1
-                                            shortLyrics.append(songPath)
-                                        else:
-                                            # Perform analysis ONLY if lyrics are in English
-                                            songLanguage = detectLanguage(lyrics)
-                                            if songLanguage != 'en':
-                                                nonEnglishSongsCount += 1
-                                                nonEnglishSongs.append('(' + songLanguage + '): ' + songPath)
-                                            else:
-                                                # Run sentiment analysis and get the compound score. Categorize the song lyrics with a sentiment 1 to 5: 
-                                                # 1 Very bad    : compound  < -0.6
-                                                # 2 Bad         : compound >= -0.6 and < -0.2
-                                                # 3 Neutral     : compound >= -0.2 and <= 0.2
-                                                # 4 Good        : compound  >  0.2 and <= 0.6
-                                                # 5 Very Good   : compound  >  0.6
-
-                                                # Remove stop words - EVALUATE IF THIS YELD BETTER RESULTS OR NOT
-                                                lyricsNoStopWords = removeStopWords(lyrics)
-
-                                                # Get the compound sentiment. Can be full lyrics, verse or line averages
-                                                compound = getAverageCompound(lyricsNoStopWords,scope, True, song)
-
-                                                # NOTE: Sentiment analysis is run on lyrics that are tokenized and WITHOUT stop words. However... 
-                                                # ... when we DO categorize songs and want to make them available for search, 
-                                                # they will be stored in their original form.
-
-                                                newSong = []
-                                                newSong.append(song)
-                                                newSong.append(artist)
-                                                newSong.append(lyrics)
-
-                                                sentiment = 0
-                                                if (compound < -0.6):
-                                                    sentiment = 1
-                                                    songsByCategory['1_very_bad'] += 1
-                                                elif (compound >= -0.6) and (compound < -0.2):
-                                                    sentiment = 2
-                                                    songsByCategory['2_bad'] += 1
-                                                elif (compound >= -0.2) and (compound <= 0.2):
-                                                    sentiment = 3
-                                                    songsByCategory['3_neutral'] += 1
-                                                elif (compound > 0.2) and (compound <= 0.6):
-                                                    sentiment = 4
-                                                    songsByCategory['4_good'] += 1
-                                                elif (compound > 0.6):
-                                                    sentiment = 5
-                                                    songsByCategory['5_very_good'] += 1
-
-                                                newSong.append(sentiment)
-                                                songData.loc[len(songData)] = newSong
-                                                successesCount += 1
-
-                                    except Exception as e:
-                                        print('Exception: ', e)
-                                        print('Current song: ', songPath)
-                                        failedSongs.append(songPath)
-                                        failedSongsCount += 1
-
-                                    # Print status at every 10%
-                                    tenPercent = int(round(fileCount / 10,0))
-                                    songsProcessedCount = successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount
-                                    if (successesCount > 0) and ((songsProcessedCount) % tenPercent == 0):
-                                        percentage = int((songsProcessedCount) / fileCount * 100)
-                                        print(str(songsProcessedCount), 'songs analyzed...',''.join(['(', str(percentage),'%)']))
-
-    print(str(successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount), 'songs analyzed. (100%)')
+    songTasks = ((songPath, song, artist, album, scope, compareScopes, previousSongs.get(getManifestKey(songPath)), languageDetector, content, thresholds) for songPath, artist, album, song, content in songSource.readSongs())
+    if workers > 1:
+        print('Categorizing songs with', str(workers), 'worker processes...')
+        pool = multiprocessing.Pool(workers)
+        chunkSize = max(1, min(64, fileCount // (workers * 16)))
+        songResults = pool.imap(analyzeSongTask, songTasks, chunkSize)
+    else:
+        pool = None
+        songResults = map(analyzeSongTask, songTasks)
+
+    try:
+        for result in songResults:
+            songPath = result['path']
+            if result['status'] != 'failed':
+                manifestSongs[getManifestKey(songPath)] = {field: result[field] for field in ['hash'] + manifestFields if field in result}
+            if result.get('cached'):
+                reusedSongsCount += 1
+            metrics.addSong(songPath, result['timings'])
+            if 'detectLanguage' in result['timings']:
+                languageDetectionCount += 1
+                languageDetectionTime += result['timings']['detectLanguage'][0]
+            if result['status'] == 'short':
+                shortLyricsCount += 1
+                shortLyrics.append(songPath)
+            elif result['status'] == 'nonEnglish':
+                nonEnglishSongsCount += 1
+                nonEnglishSongs.append('(' + result['language'] + '): ' + songPath)
+            elif result['status'] == 'failed':
+                print('Exception: ', result['error'])
+                print('Current song: ', songPath)
+                failedSongs.append(songPath)
+                failedSongsCount += 1
+            else:
+                # NOTE: Sentiment analysis is run on lyrics that are tokenized and WITHOUT stop words. However... 
+                # ... when we DO categorize songs and want to make them available for search, 
+                # they will be stored in their original form.
+                newSong = [result['title'], result['artist'], result['album'], result['sentiment'], result['compound'],
+                           result['displayTitle'], result['explicit'], getSongLink(result['title'], result['artist'])]
+                if compareScopes:
+                    newSong += [result['scopeCompounds'][otherScope] for otherScope in acceptedScopes]
+                if result['sentiment'] > 0:
+                    songsByCategory[categoryNames[result['sentiment'] - 1]] += 1
+                with metrics.measure('writeSongDatabase', len(result['lyrics'].encode('utf-8'))):
+                    songData.addSong(newSong, result['lyrics'])
+                successesCount += 1
+
+            # Print status at every 10%, with the throughput so far and the estimated time left
+            tenPercent = max(1, int(round(fileCount / 10,0)))
+            songsProcessedCount = successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount
+            if (successesCount > 0) and ((songsProcessedCount) % tenPercent == 0):
+                percentage = int((songsProcessedCount) / fileCount * 100)
+                songsPerSecond = songsProcessedCount / max(time.time() - startTime, 1e-6)
+                print(str(songsProcessedCount), 'songs analyzed...',''.join(['(', str(percentage),'%)']), '-', str(round(songsPerSecond, 1)), 'songs per second, ETA', formatDuration(max(fileCount - songsProcessedCount, 0) / songsPerSecond))
+    except BaseException:
+        # Keep what was categorized so far in music.csv.partial and lyrics.bin.partial
+        songData.abort()
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        songSource.close()
+    metrics.record('readFile', songSource.readSeconds, songSource.bytesRead, songSource.filesRead)
+
+    analysisTime = time.time() - startTime
+    print(str(successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount), 'songs analyzed. (100%)', '-', str(round((successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount) / max(analysisTime, 1e-6), 1)), 'songs per second')
+    if incremental:
+        print('Songs reused from', manifestFile + ':', str(reusedSongsCount), '(unchanged since the previous run)')
     print('')
 
-    # Finished processing. Save dataframe to CSV
+    # Finished processing. Save the song database, and the outcome of each song file for incremental runs
     try:
-        songData.to_csv(songFile)
+        with metrics.measure('writeSongDatabase', calls=0):
+            songData.close()
+        with metrics.measure('saveManifest'):
+            saveManifest(scope, manifestSongs, languageDetector, thresholds)
     except Exception as e:
         print('Processing succeeded, but failed to write songData file')
         print('Exception: ', e)
@@ -303,6 +618,8 @@ def categorizeSongs(scope):
     print(' --- Non-English*..........:', str(nonEnglishSongsCount))
     print(' --- Short lyrics*.........:', str(shortLyricsCount))
     print(' --- Failures*.............:', str(failedSongsCount))
+    if languageDetectionCount > 0:
+        print(' --- Language detection....:', str(round(languageDetectionTime / languageDetectionCount * 1000, 2)), 'ms per song', '(' + languageDetector + ',', str(languageDetectionCount), 'songs)')
     print(' --- Songs in each category:')
     print('           1-Very Bad.........:', str(songsByCategory['1_very_bad']))
     print('           2-Bad..............:', str(songsByCategory['2_bad']))
@@ -373,22 +690,156 @@ def categorizeSongs(scope):
     finally:
         logFile.close()
 
+    # Write the run report next to the log file: time spent on each stage, and the slowest songs
+    songsAnalyzedCount = successesCount + failedSongsCount + nonEnglishSongsCount + shortLyricsCount
+    metrics.info.update({
+        'startedAt': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(startTime)),
+        'scope': scope,
+        'workers': workers,
+        'incremental': incremental,
+        'languageDetector': languageDetector,
+        'thresholds': list(thresholds),
+        'songsScanned': fileCount,
+        'songsAnalyzed': songsAnalyzedCount,
+        'successes': successesCount,
+        'shortLyrics': shortLyricsCount,
+        'nonEnglish': nonEnglishSongsCount,
+        'failures': failedSongsCount,
+        'reused': reusedSongsCount,
+        'analysisSeconds': round(analysisTime, 3),
+        'songsPerSecond': round(songsAnalyzedCount / max(analysisTime, 1e-6), 1),
+        'elapsedSeconds': round(time.time() - startTime, 3)
+    })
+    metrics.reportFile = logFileName + '.json'
+    try:
+        metrics.save()
+        print('Run report written successfully:', metrics.reportFile)
+    except Exception as e:
+        print('Failed to write run report. Exception:', str(e))
+
+    if not incremental:
+        return None
+
+    # Sentiments that gained, lost or changed songs need their index rebuilt
+    previousBySentiment = getSongsBySentiment(previousSongs)
+    currentBySentiment = getSongsBySentiment(manifestSongs)
+    return set(i for i in range(1,6) if previousBySentiment[i] != currentBySentiment[i])
+
 # ------------------------------------------------------------------------
 # ------------------------------------------------------------------------
 #                        SCRIPT STARTS HERE
 # ------------------------------------------------------------------------
 # ------------------------------------------------------------------------
-print('===============================================================================================================')
-print('||                               MY KIND OF MUSIC - DATA PREPARATION SCRIPT                                  ||')
-print('|| Song Sentiment Analysis | V1 | written by Peri Rocha                                                      ||')
-print('|| Text Retrieval indexing | V1 | written by Gunther Bacellar                                                ||')
-print('|| built for CS410 Text Information Systems at University of Illinois at Urbana-Champaign                    ||')
-print('||                                                                                                           ||')
-print('|| Use of parts of this program is free as long as we are cited as the source                                ||')
-print('|| github.com/periclesrocha                                                                                  ||')
-print('===============================================================================================================')
-print('')
-
-categorizeSongs(scope)
-createIndexes()
-print('')
\ No newline at end of file
+if __name__ == '__main__':
+    # Determine arguments passed to the script. The script accepts the scope and, optionally, the number of workers
+    # Accepted values for scope: 'full','verse','line'
+    # If no scope is passed, we will use 'verse' as the default.
+    # --workers N categorizes songs in N parallel processes. If not passed, songs are categorized serially.
+    # --compare-scopes also writes the compound of every scope to the song database.
+    # --incremental only analyzes songs added or changed since the previous run, and only rebuilds the
+    #   index if songs changed.
+    # --language-detector local|textblob selects how languages are detected. 'local' (default) runs offline.
+    # --refresh-display only computes the censored titles, explicit flags and links of the song database
+    #   again (e.g. after the profanity wordlist changed). Songs are not analyzed and indexes are not created.
+    # --source PATH reads the song files from another directory, or from a zip or tar archive (optionally
+    #   compressed with gzip, bzip2 or xz) without extracting it. If not passed, 'database_source' is used.
+    # --thresholds A,B,C,D sets the compound scores that separate the five sentiments (default -0.6,-0.2,0.2,0.6).
+    #   They are kept for the next runs.
+    # --rebucket categorizes the songs of the song database again with the thresholds given with --thresholds,
+    #   from the compound stored in music.csv. Songs are not analyzed and the index is not rebuilt.
+    # --reindex only builds the index again from the song database. Songs are not analyzed, and songs
+    #   tokenized by a previous index build are taken from the token cache.
+    # --k1 K1 and --b B set the BM25 parameters of the index (default 1.5 and 0.75).
+    # If an argument is invalid, we will halt execution. 
+    acceptedArgs = ['full','verse','line']
+    scope = 'verse' #Default
+    workers = 1     #Default
+    compareScopes = False
+    incremental = False
+    languageDetector = 'local'
+    refreshDisplay = False
+    source = 'database_source'
+    thresholds = None
+    rebucket = False
+    reindex = False
+    k1 = 1.5
+    b = 0.75
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--workers':
+            if len(args) == 0 or not args[0].isdigit() or int(args[0]) < 1:
+                raise Exception("Invalid value for --workers argument. Expected a positive number of processes.")
+            workers = int(args.pop(0))
+        elif arg == '--compare-scopes':
+            compareScopes = True
+        elif arg == '--incremental':
+            incremental = True
+        elif arg == '--refresh-display':
+            refreshDisplay = True
+        elif arg == '--rebucket':
+            rebucket = True
+        elif arg == '--reindex':
+            reindex = True
+        elif arg in ['--k1', '--b']:
+            try:
+                value = float(args.pop(0)) if len(args) > 0 else -1
+            except ValueError:
+                value = -1
+            if value < 0 or (arg == '--b' and value > 1):
+                raise Exception("Invalid value for " + arg + " argument. Expected " + ("a number from 0 to 1." if arg == '--b' else "a positive number."))
+            if arg == '--k1':
+                k1 = value
+            else:
+                b = value
+        elif arg == '--thresholds':
+            try:
+                thresholds = [float(threshold) for threshold in args.pop(0).split(',')] if len(args) > 0 else []
+            except ValueError:
+                thresholds = []
+            if len(thresholds) != 4 or thresholds != sorted(thresholds) or thresholds[0] < -1 or thresholds[-1] > 1:
+                raise Exception("Invalid value for --thresholds argument. Expected four increasing compound scores from -1 to 1, separated by commas (e.g. -0.6,-0.2,0.2,0.6).")
+        elif arg == '--source':
+            if len(args) == 0 or not os.path.exists(args[0]):
+                raise Exception("Invalid value for --source argument. Expected a song database directory or archive.")
+            source = args.pop(0)
+        elif arg == '--language-detector':
+            if len(args) == 0 or args[0].lower() not in acceptedLanguageDetectors:
+                raise Exception("Invalid value for --language-detector argument. Accepted: 'local' or 'textblob'.")
+            languageDetector = args.pop(0).lower()
+        else: # If parameters passed, see if it is accepted
+            scope = arg.lower()
+            if scope not in acceptedArgs:
+                raise Exception("Invalid value for scope argument. Accepted: 'full', 'verse' or 'line'. Provided: ", scope)
+
+    print('===============================================================================================================')
+    print('||                               MY KIND OF MUSIC - DATA PREPARATION SCRIPT                                  ||')
+    print('|| Song Sentiment Analysis | V1 | written by Peri Rocha                                                      ||')
+    print('|| Text Retrieval indexing | V1 | written by Gunther Bacellar                                                ||')
+    print('|| built for CS410 Text Information Systems at University of Illinois at Urbana-Champaign                    ||')
+    print('||                                                                                                           ||')
+    print('|| Use of parts of this program is free as long as we are cited as the source                                ||')
+    print('|| github.com/periclesrocha                                                                                  ||')
+    print('===============================================================================================================')
+    print('')
+
+    if refreshDisplay:
+        refreshDisplayFields(workers)
+        sys.exit(0)
+
+    if rebucket:
+        if thresholds is None:
+            raise Exception("--rebucket needs the new thresholds: --thresholds A,B,C,D")
+        rebucketSongs(thresholds)
+        sys.exit(0)
+
+    if reindex:
+        createIndexes(None, None, workers, k1, b)
+        sys.exit(0)
+
+    # Time spent on each stage of both steps goes to the same run report
+    metrics = RunMetrics()
+    changedSentiments = categorizeSongs(scope, workers, compareScopes, incremental, languageDetector, metrics, source, thresholds)
+    createIndexes(changedSentiments, metrics, workers, k1, b)
+    print('')
@@ -0,0 +1,146 @@
+## expansion.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## EXPANSION OF MISSPELLED AND PARTIALLY TYPED QUERY TERMS WITH TERMS OF THE INDEX VOCABULARY
+
+import threading
+import time
+
+import numpy as np
+
+from bm25index import SortedVocabulary
+
+expansionTimeBudget = 0.005     # Seconds a query can spend on expansion. Terms left when it runs out are not expanded.
+maxExpansions = 3               # Vocabulary terms a query term can be expanded to
+minPrefixLength = 3             # Shortest query term completed as a prefix
+
+# Edit distance allowed to correct a query term: short words have too many neighbors to be corrected
+def getMaxDistance(term):
+    if len(term) < 4:
+        return 0
+    if len(term) < 8:
+        return 1
+    return 2
+
+# Optimal string alignment distance (insertions, deletions, substitutions and transpositions of adjacent
+# characters) between two words, or maxDistance + 1 if it is larger than maxDistance
+def getEditDistance(word, other, maxDistance):
+    if abs(len(word) - len(other)) > maxDistance:
+        return maxDistance + 1
+    beforeLastRow = None
+    lastRow = list(range(len(other) + 1))
+    for i in range(1, len(word) + 1):
+        row = [i] + [0] * len(other)
+        for j in range(1, len(other) + 1):
+            cost = 0 if word[i - 1] == other[j - 1] else 1
+            row[j] = min(lastRow[j] + 1, row[j - 1] + 1, lastRow[j - 1] + cost)
+            if i > 1 and j > 1 and word[i - 1] == other[j - 2] and word[i - 2] == other[j - 1]:
+                row[j] = min(row[j], beforeLastRow[j - 2] + 1)
+        if min(row) > maxDistance:
+            return maxDistance + 1
+        beforeLastRow, lastRow = lastRow, row
+    return min(lastRow[-1], maxDistance + 1)
+
+# Expands query terms that are not in the vocabulary of an index file:
+# - a partially typed term is completed with the most frequent terms that start with it ('heartbr' ->
+#   'heartbreak'), found by binary search in the sorted vocabulary
+# - a misspelled term is corrected to the closest, most frequent term within a small edit distance
+#   ('beutiful' -> 'beautiful'), found with the delete index of the vocabulary
+# A term is expanded to at most maxExpansions terms, which share the weight of the original term.
+# Terms in the vocabulary are kept as they are, so queries without typos give the same results.
+# Expansion of a query stops when it has used timeBudget seconds; the time spent and the number of
+# queries that ran out of time are counted to check the budget (see getStats()).
+class QueryExpander:
+    def __init__(self, index, timeBudget=expansionTimeBudget):
+        if not isinstance(index.vocabulary, SortedVocabulary):
+            raise Exception("Query expansion needs an index read from an index file.")
+        self.vocabulary = index.vocabulary
+        self.deleteIndex = index.deleteIndex            # None for index files written before version 3: no corrections
+        self.docFreqs = np.diff(index.postingOffsets)   # Songs that contain each term, to prefer common terms
+        self.timeBudget = timeBudget
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.expandedTerms = 0
+        self.outOfTime = 0
+        self.seconds = 0
+        self.maxSeconds = 0
+
+    # Returns (terms, weights, complete): the query terms with the expansions of the terms that are not in
+    # the vocabulary, the weight of each term, and False if expansion ran out of time
+    def expandQuery(self, tokenizedQuery):
+        startTime = time.perf_counter()
+        deadline = startTime + self.timeBudget
+        terms, weights = [], []
+        complete = True
+        expandedTerms = 0
+        for term in tokenizedQuery:
+            if self.vocabulary.get(term) is not None:
+                terms.append(term)
+                weights.append(1)
+                continue
+            if time.perf_counter() > deadline:
+                complete = False
+                terms.append(term)
+                weights.append(1)
+                continue
+
+            expansions = self.getExpansions(term, deadline)
+            if expansions is None:
+                complete = False
+                expansions = []
+            if len(expansions) == 0:
+                terms.append(term)
+                weights.append(1)
+            else:
+                expandedTerms += 1
+                terms += expansions
+                weights += [1 / len(expansions)] * len(expansions)
+
+        seconds = time.perf_counter() - startTime
+        with self.lock:
+            self.queries += 1
+            self.expandedTerms += expandedTerms
+            self.outOfTime += 0 if complete else 1
+            self.seconds += seconds
+            self.maxSeconds = max(self.maxSeconds, seconds)
+        return terms, weights, complete
+
+    # Vocabulary terms for a term that is not in the vocabulary: the best spelling correction, then the
+    # most frequent prefix completions. Returns None if the deadline passed before all were found.
+    def getExpansions(self, term, deadline):
+        expansions = []
+        maxDistance = getMaxDistance(term)
+        if self.deleteIndex is not None and maxDistance > 0:
+            # The closest correction; among corrections at the same distance, the most frequent term
+            bestCorrection = None
+            for count, termId in enumerate(self.deleteIndex.getCandidates(term, maxDistance).tolist()):
+                if count % 32 == 31 and time.perf_counter() > deadline:
+                    return None
+                candidate = self.vocabulary.getTerm(termId)
+                distance = getEditDistance(term, candidate, maxDistance)
+                if distance <= maxDistance:
+                    key = (distance, -int(self.docFreqs[termId]), candidate)
+                    if bestCorrection is None or key < bestCorrection:
+                        bestCorrection = key
+            if bestCorrection is not None:
+                expansions.append(bestCorrection[2])
+
+        if len(term) >= minPrefixLength:
+            first, last = self.vocabulary.getPrefixRange(term)
+            if last > first:
+                best = np.argsort(-self.docFreqs[first:last], kind='stable')[:maxExpansions]
+                for termId in best:
+                    completion = self.vocabulary.getTerm(first + int(termId))
+                    if len(expansions) < maxExpansions and completion not in expansions:
+                        expansions.append(completion)
+        return expansions
+
+    def getStats(self):
+        with self.lock:
+            return {
+                'queries': self.queries,
+                'expandedTerms': self.expandedTerms,
+                'outOfTime': self.outOfTime,
+                'timeBudgetMs': self.timeBudget * 1000,
+                'averageMs': self.seconds / self.queries * 1000 if self.queries > 0 else 0,
+                'maxMs': self.maxSeconds * 1000
+            }
@@ -0,0 +1,264 @@
+## ingest.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## STREAMING INGESTION OF SONG FILES FROM A DIRECTORY TREE OR AN ARCHIVE
+
+import os
+import queue
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+
+# Archives that can be read without extracting them. Tar archives can be compressed with gzip, bzip2 or xz.
+archiveExtensions = ['.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz']
+
+defaultQueueSize = 256      # Song files read ahead of the songs being analyzed
+
+def isArchive(path):
+    return os.path.isfile(path) and any(path.lower().endswith(extension) for extension in archiveExtensions)
+
+# Song files of a song database: a directory, or a zip or tar archive of it, with the layout
+# [ArtistFirstLetter]/[ArtistName]/[AlbumName]/[LyricsFile]. An archive may also have every file under a
+# single top directory (e.g. database_source/A/...), as written by packSongFiles().
+# Song files are listed once, when the source is opened, in the order they are categorized: letters sorted
+# by name, and artists, albums and songs sorted by name ignoring case. Listing a directory uses os.scandir,
+# which gets the type of each entry from the directory itself, without a stat call per file.
+# Tar archives are the exception: they are read as a stream, so their songs are categorized in the order
+# of the archive (see listTarSongs()).
+# readSongs() then reads the files in a background thread, a bounded number of files ahead of the caller.
+class SongSource:
+    def __init__(self, path):
+        self.path = path
+        self.archive = None     # Open zip archive. Tar archives are opened by each pass over them.
+        self.isTar = False
+        if isArchive(path):
+            if path.lower().endswith('.zip'):
+                self.archive = zipfile.ZipFile(path)
+                members = {info.filename: info.filename for info in self.archive.infolist() if not info.is_dir()}
+                self.songFiles = listArchiveSongs(members)
+            else:
+                self.isTar = True
+                self.songFiles = listTarSongs(path)
+        elif os.path.isdir(path):
+            self.songFiles = list(scanSongDirectory(path))
+        else:
+            raise Exception("Song database not found: " + path + ". Expected a directory or a " + ', '.join(archiveExtensions) + " archive.")
+
+        self.stopped = threading.Event()    # Set by close(), so a background reader stops
+        self.producer = None
+
+        # Statistics of the files read by readSongs()
+        self.filesRead = 0
+        self.bytesRead = 0
+        self.readSeconds = 0
+
+    def __len__(self):
+        return len(self.songFiles)
+
+    # Yields (songPath, artist, album, song) of every song file, without reading them
+    def __iter__(self):
+        for songPath, artist, album, song, _ in self.songFiles:
+            yield songPath, artist, album, song
+
+    def readFile(self, songPath, member):
+        if self.archive is None:
+            with open(songPath, 'rb') as songFile:
+                return songFile.read()
+        return self.archive.read(member)
+
+    # Yields ((songPath, artist, album, song, member), content) of every song file, in order. content is
+    # the exception raised if the file could not be read.
+    def readFiles(self):
+        if self.isTar:
+            yield from self.readTarFiles()
+            return
+        for songFile in self.songFiles:
+            try:
+                content = self.readFile(songFile[0], songFile[4])
+            except Exception as e:
+                content = e
+            yield songFile, content
+
+    # Reads the song files of a tar archive in a single pass over the archive, as a stream: members can
+    # only be read in the order they are stored, as compressed tar archives cannot seek back.
+    def readTarFiles(self):
+        pending = iter(self.songFiles)
+        songFile = next(pending, None)
+        with tarfile.open(self.path, 'r|*') as archive:
+            for info in archive:
+                if songFile is None:
+                    break
+                if info.name != songFile[0]:
+                    continue
+                try:
+                    with archive.extractfile(info) as memberFile:
+                        content = memberFile.read()
+                except Exception as e:
+                    content = e
+                yield songFile, content
+                songFile = next(pending, None)
+        # Files removed from the archive since it was listed
+        while songFile is not None:
+            yield songFile, Exception('Song file not found in archive: ' + songFile[0])
+            songFile = next(pending, None)
+
+    # Yields (songPath, artist, album, song, content) of every song file, in order. Files are read by a
+    # background thread and handed over through a queue of queueSize files, so reading overlaps with the
+    # analysis of previous songs while memory use stays bounded. If a file cannot be read, content is the
+    # exception raised, so the caller can report that song as failed and go on with the next ones.
+    def readSongs(self, queueSize=defaultQueueSize):
+        songQueue = queue.Queue(queueSize)
+        stopped = threading.Event()
+        endOfSongs = object()
+        self.stopped = stopped
+
+        def produce():
+            files = self.readFiles()
+            try:
+                while True:
+                    startTime = time.perf_counter()
+                    record = next(files, None)
+                    self.readSeconds += time.perf_counter() - startTime
+                    if record is None:
+                        break
+                    (songPath, artist, album, song, _), content = record
+                    if not isinstance(content, Exception):
+                        self.bytesRead += len(content)
+                    self.filesRead += 1
+                    if not putUnlessStopped(songQueue, (songPath, artist, album, song, content), stopped):
+                        return
+            except BaseException as e:
+                putUnlessStopped(songQueue, e, stopped)
+                return
+            finally:
+                files.close()
+            putUnlessStopped(songQueue, endOfSongs, stopped)
+
+        producer = threading.Thread(target=produce, name='SongReader', daemon=True)
+        self.producer = producer
+        producer.start()
+        try:
+            while True:
+                record = songQueue.get()
+                if record is endOfSongs:
+                    break
+                if isinstance(record, BaseException):
+                    raise record
+                yield record
+        finally:
+            # The caller may stop early: let the producer exit, so it does not read files nobody will use
+            stopped.set()
+            producer.join()
+
+    # Stops the background reader, if any, and closes the archive
+    def close(self):
+        self.stopped.set()
+        if self.producer is not None and self.producer is not threading.current_thread():
+            self.producer.join()
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+# Puts an item in a bounded queue, waiting for room unless stopped is set. Returns False if stopped.
+def putUnlessStopped(itemQueue, item, stopped):
+    while not stopped.is_set():
+        try:
+            itemQueue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+# Lists the song files of a directory with os.scandir, in categorization order.
+# Yields (songPath, artist, album, song, None).
+def scanSongDirectory(dbDir):
+    for letter in scanEntries(dbDir, str):
+        # For each letter...
+        for artist in scanEntries(letter.path, str.lower):
+            # ... iterate through artists...
+            for album in scanEntries(artist.path, str.lower):
+                # ... then through albums...
+                for song in scanEntries(album.path, str.lower, directories=False):
+                    # ... and then each song inside an album.
+                    yield song.path, artist.name, album.name, song.name, None
+
+# Subdirectories (or files) of a directory, sorted by name with the given key
+def scanEntries(path, key, directories=True):
+    with os.scandir(path) as entries:
+        if directories:
+            selected = [entry for entry in entries if entry.is_dir()]
+        else:
+            selected = [entry for entry in entries if entry.is_file()]
+    return sorted(selected, key=lambda entry: key(entry.name))
+
+# Lists the song files of a tar archive, reading it once as a stream, in the order of the archive. Songs are
+# categorized in this order: reading a compressed tar archive in another order would decompress it again
+# from the start for every file. If the order differs from the order of a directory, a warning is shown, as
+# music.csv will not have the same order as when categorizing the directory (pack with packSongFiles() to
+# keep it). Returns a list of (songPath, artist, album, song, None).
+def listTarSongs(path):
+    with tarfile.open(path, 'r|*') as archive:
+        members = {info.name: None for info in archive if info.isfile()}
+    songFiles = listArchiveSongs(members)
+    archiveOrder = {name: position for position, name in enumerate(members)}
+    archiveSongFiles = sorted(songFiles, key=lambda songFile: archiveOrder[songFile[0]])
+    if archiveSongFiles != songFiles:
+        print('Warning: song files of', path, 'are not stored in categorization order. Songs are categorized in the order of the archive.')
+    return archiveSongFiles
+
+# Lists the song files of an archive, in categorization order, from its members ({name: member}).
+# Returns a list of (songPath, artist, album, song, member). songPath is the name of the file in the archive.
+def listArchiveSongs(members):
+    splitNames = {name: name.strip('/').split('/') for name in members}
+    topDirectories = set(parts[0] for parts in splitNames.values())
+    # Files are either directly in letter directories, or all under a single top directory
+    depth = 5 if len(topDirectories) == 1 and all(len(parts) == 5 for parts in splitNames.values()) else 4
+
+    tree = {}
+    for name, parts in splitNames.items():
+        if len(parts) == depth:
+            letter, artist, album, song = parts[-4:]
+            tree.setdefault(letter, {}).setdefault(artist, {}).setdefault(album, []).append((song, name))
+
+    songFiles = []
+    for letter in sorted(tree):
+        for artist in sorted(tree[letter], key=str.lower):
+            for album in sorted(tree[letter][artist], key=str.lower):
+                for song, name in sorted(tree[letter][artist][album], key=lambda songName: songName[0].lower()):
+                    songFiles.append((name, artist, album, song, members[name]))
+    return songFiles
+
+# Writes the song files of a directory to an archive (zip, or tar compressed according to the extension),
+# under a top directory with the name of the directory and in categorization order, so songs of the
+# archive are categorized in the same order as songs of the directory.
+def packSongFiles(dbDir, archivePath):
+    topDirectory = os.path.basename(os.path.normpath(dbDir))
+    with SongSource(dbDir) as songSource:
+        songFiles = list(songSource)
+
+    if archivePath.lower().endswith('.zip'):
+        with zipfile.ZipFile(archivePath, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for songPath, artist, album, song in songFiles:
+                archive.write(songPath, topDirectory + '/' + os.path.relpath(songPath, dbDir).replace(os.sep, '/'))
+    else:
+        mode = 'w:gz' if archivePath.lower().endswith(('.gz', '.tgz')) else 'w:bz2' if archivePath.lower().endswith(('.bz2', '.tbz2')) else 'w:xz' if archivePath.lower().endswith(('.xz', '.txz')) else 'w'
+        with tarfile.open(archivePath, mode) as archive:
+            for songPath, artist, album, song in songFiles:
+                archive.add(songPath, topDirectory + '/' + os.path.relpath(songPath, dbDir).replace(os.sep, '/'))
+    return len(songFiles)
+
+# Packs a song database directory into one archive file.
+# Usage: python ingest.py <database directory> <archive: .zip, .tar, .tar.gz, .tar.bz2 or .tar.xz>
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        raise Exception("Usage: python ingest.py <database directory> <archive file>")
+    print('Packing', sys.argv[1], 'into', sys.argv[2] + '...')
+    print(str(packSongFiles(sys.argv[1], sys.argv[2])), 'song files packed.')
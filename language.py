@@ -0,0 +1,177 @@
+## language.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## OFFLINE LANGUAGE DETECTION OF SONG LYRICS WITH CHARACTER N-GRAM PROFILES
+
+import collections
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+
+import numpy as np
+
+profileFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'language_profiles.json')
+
+ngramSize = 3           # Character trigrams
+prefixLength = 1000     # Only the first characters of the lyrics are needed to tell the language
+profileSize = 2000      # Most frequent trigrams kept for each language
+undetermined = 'und'    # Language code of texts no profile fits (ISO 639 code for an undetermined language)
+
+# Lowercases text and keeps only letters, so trigrams are not affected by punctuation or numbers
+def normalizeText(text):
+    return ' ' + ' '.join(re.findall(r"[^\W\d_]+", text.lower())) + ' '
+
+# Counts the character trigrams of a text
+def getNgrams(text):
+    text = normalizeText(text)
+    return collections.Counter(text[i:i + ngramSize] for i in range(len(text) - ngramSize + 1))
+
+# Identifies the language of lyrics locally, without any network access, by comparing their character
+# trigrams with the trigram profile of each language (naive Bayes). Only a prefix of each text is scored,
+# and results are cached by the hash of that prefix, so repeated lyrics are only scored once.
+# Profiles exist for a few languages only (see language_profiles.json). A text whose closest profile fits it
+# poorly, with a mean log probability per trigram below minNgramLogProb, is in a language without a profile
+# and is reported as undetermined ('und') rather than as the closest language. English is always reported
+# when it is the closest language: its profile is built from thousands of songs, and English lyrics that fit
+# it poorly are slang or made-up words rather than another language.
+# With the profiles built from database_source, a minimum of -10 labels 14 of the 19 songs the 2021 log
+# found in languages without a profile as undetermined, and changes the label of 1 of the 460 German,
+# French and Spanish songs.
+class LanguageIdentifier:
+    def __init__(self, profiles, maxCachedTexts=100000, minNgramLogProb=-10.0, confidentLanguages=('en',)):
+        self.languages = sorted(profiles)
+        self.minNgramLogProb = minNgramLogProb
+        self.confidentLanguages = set(confidentLanguages)
+        self.featureIds = {}
+        for language in self.languages:
+            for ngram in profiles[language]['ngrams']:
+                self.featureIds.setdefault(ngram, len(self.featureIds))
+
+        # Log probability of every trigram for every language, and of trigrams outside the profile
+        self.logProbs = np.zeros((len(self.featureIds), len(self.languages)), dtype=np.float64)
+        self.unseenLogProbs = np.array([profiles[language]['unseen'] for language in self.languages], dtype=np.float64)
+        for column, language in enumerate(self.languages):
+            self.logProbs[:, column] = self.unseenLogProbs[column]
+            for ngram, logProb in profiles[language]['ngrams'].items():
+                self.logProbs[self.featureIds[ngram], column] = logProb
+
+        self.maxCachedTexts = maxCachedTexts
+        self.cache = {}
+
+    @classmethod
+    def fromFile(cls, path=profileFile):
+        with open(path, 'r', encoding='utf-8') as pf:
+            return cls(json.load(pf)['profiles'])
+
+    # Detects the language of a text. Returns a language code, or 'und' if no profile fits it. Only the rows of the trigrams found in the
+    # text are added up, weighted by their count, instead of a row of counts for every known trigram.
+    def detectLanguage(self, text):
+        prefix = text[:prefixLength]
+        key = hashlib.sha1(prefix.encode('utf-8')).hexdigest()
+        language = self.cache.get(key)
+        if language is None:
+            featureIds = []
+            counts = []
+            unseenCount = 0     # Trigrams no profile knows about
+            for ngram, count in getNgrams(prefix).items():
+                featureId = self.featureIds.get(ngram)
+                if featureId is None:
+                    unseenCount += count
+                else:
+                    featureIds.append(featureId)
+                    counts.append(count)
+
+            ngramCount = sum(counts) + unseenCount
+            scores = np.array(counts, dtype=np.float64) @ self.logProbs[featureIds] + unseenCount * self.unseenLogProbs
+            best = int(np.argmax(scores))
+            language = self.languages[best]
+            if ngramCount == 0 or (language not in self.confidentLanguages and scores[best] / ngramCount < self.minNgramLogProb):
+                language = undetermined
+            if len(self.cache) >= self.maxCachedTexts:
+                self.cache.clear()
+            self.cache[key] = language
+        return language
+
+# One identifier per process, loaded the first time a language is detected
+_identifier = None
+
+def getIdentifier():
+    global _identifier
+    if _identifier is None:
+        _identifier = LanguageIdentifier.fromFile()
+    return _identifier
+
+# Builds the language profiles from labeled texts: {language: [text, ...]}
+# Trigram probabilities are smoothed towards the trigram distribution of all languages together
+# (Dirichlet smoothing), so languages with only a few songs do not attract texts of other languages.
+def buildProfiles(textsByLanguage, smoothing=2000):
+    counts = {}
+    backgroundCounts = collections.Counter()
+    for language, texts in textsByLanguage.items():
+        counts[language] = collections.Counter()
+        for text in texts:
+            counts[language].update(getNgrams(text[:prefixLength]))
+        backgroundCounts.update(counts[language])
+
+    backgroundTotal = sum(backgroundCounts.values()) + len(backgroundCounts) + 1
+    profiles = {}
+    for language, languageCounts in counts.items():
+        total = sum(languageCounts.values()) + smoothing
+        ngrams = {}
+        for ngram, count in languageCounts.most_common(profileSize):
+            backgroundProb = (backgroundCounts[ngram] + 1) / backgroundTotal
+            ngrams[ngram] = round(math.log((count + smoothing * backgroundProb) / total), 4)
+        profiles[language] = {
+            'ngrams': ngrams,
+            'unseen': round(math.log(smoothing / backgroundTotal / total), 4)
+        }
+    return profiles
+
+# Reads labeled lyrics from the song database and a sentiment-analysis log file: songs listed as
+# non-English in the log are labeled with the language reported there, and songs that were categorized
+# are English. Undetermined songs and languages with fewer than minSongs songs are left out.
+def getLabeledLyrics(dbDir, logFileName, minSongs=5):
+    # Imported here: dataprep is only needed to rebuild the profiles, not to detect languages
+    from dataprep import decodeLyrics, removeLyricMetadata
+    from ingest import SongSource
+
+    labels = {}
+    section = ''
+    with open(logFileName, 'r', encoding='utf-8') as logFile:
+        for line in logFile:
+            if line.startswith('List of'):
+                section = line
+            elif line.startswith(' --- ') and section.startswith('List of Non-english'):
+                language, path = line[5:].rstrip('\n').split(': ', 1)
+                language = language.strip('()')
+                labels[path.replace('\\', '/')] = language if language != undetermined else None
+            elif line.startswith(' --- ') and section.startswith('List of short'):
+                labels[line[5:].rstrip('\n').replace('\\', '/')] = None
+
+    textsByLanguage = collections.defaultdict(list)
+    with SongSource(dbDir) as songSource:
+        for songPath, _, _, _, content in songSource.readSongs():
+            language = labels.get(songPath.replace(os.sep, '/'), 'en')
+            if language is not None:
+                if isinstance(content, Exception):
+                    raise content
+                textsByLanguage[language].append(removeLyricMetadata(decodeLyrics(content)))
+
+    return {language: texts for language, texts in textsByLanguage.items() if len(texts) >= minSongs}
+
+# Rebuilds language_profiles.json. Usage: python language.py <log file> [database directory or archive]
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise Exception("Usage: python language.py <sentiment-analysis log file> [database directory or archive]")
+    dbDir = sys.argv[2] if len(sys.argv) > 2 else 'database_source'
+
+    textsByLanguage = getLabeledLyrics(dbDir, sys.argv[1])
+    profiles = buildProfiles(textsByLanguage)
+    with open(profileFile, 'w', encoding='utf-8') as pf:
+        json.dump({'version': 1, 'ngramSize': ngramSize, 'prefixLength': prefixLength, 'profiles': profiles}, pf, ensure_ascii=False)
+
+    for language, texts in sorted(textsByLanguage.items()):
+        print(language, ':', str(len(texts)), 'songs')
+    print('Language profiles written to', profileFile)
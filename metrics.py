@@ -0,0 +1,99 @@
+## metrics.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## PER-STAGE TIMING OF THE DATA PREPARATION PIPELINE AND ITS JSON RUN REPORT
+
+import heapq
+import json
+import time
+
+# Collects the wall time, number of calls and bytes processed by each stage of a data preparation run,
+# and the songs that took the longest. Song stages are measured in the process that analyzes the song
+# (see SongTimer) and added here by the main process, so with several workers the seconds of a stage
+# are the sum of the time spent on it by all workers.
+class RunMetrics:
+    def __init__(self, slowestCount=20):
+        self.stages = {}            # stage -> {'calls', 'seconds', 'bytes'}
+        self.slowestCount = slowestCount
+        self.slowestSongs = []      # Min-heap of (seconds, path, stage seconds) with the slowest songs
+        self.reportFile = None      # Set when the run has a log file. The report is written next to it.
+        self.info = {}              # Run settings and counts written at the top of the report
+
+    def record(self, stage, seconds, bytesProcessed=0, calls=1):
+        totals = self.stages.setdefault(stage, {'calls': 0, 'seconds': 0.0, 'bytes': 0})
+        totals['calls'] += calls
+        totals['seconds'] += seconds
+        totals['bytes'] += bytesProcessed
+
+    # Measures a block of code: with metrics.measure('stage'): ...
+    def measure(self, stage, bytesProcessed=0, calls=1):
+        return StageTimer(self, stage, bytesProcessed, calls)
+
+    # Adds the stage timings of a song, as returned by SongTimer.getTimings()
+    def addSong(self, path, timings):
+        totalSeconds = 0
+        for stage, (seconds, bytesProcessed) in timings.items():
+            self.record(stage, seconds, bytesProcessed)
+            totalSeconds += seconds
+
+        entry = (totalSeconds, path, {stage: round(seconds, 6) for stage, (seconds, _) in timings.items()})
+        if len(self.slowestSongs) < self.slowestCount:
+            heapq.heappush(self.slowestSongs, entry)
+        elif totalSeconds > self.slowestSongs[0][0]:
+            heapq.heapreplace(self.slowestSongs, entry)
+
+    def getReport(self):
+        stages = {}
+        for stage, totals in self.stages.items():
+            stages[stage] = {
+                'calls': totals['calls'],
+                'seconds': round(totals['seconds'], 6),
+                'bytes': totals['bytes'],
+                'msPerCall': round(totals['seconds'] / totals['calls'] * 1000, 4) if totals['calls'] > 0 else 0,
+                'mbPerSecond': round(totals['bytes'] / 1024 / 1024 / totals['seconds'], 2) if totals['seconds'] > 0 and totals['bytes'] > 0 else None
+            }
+        slowestSongs = [{'path': path, 'seconds': round(seconds, 6), 'stages': songStages} for seconds, path, songStages in sorted(self.slowestSongs, reverse=True)]
+        return dict(self.info, version=1, stages=stages, slowestSongs=slowestSongs)
+
+    # Writes the run report to reportFile. Does nothing if the run has no report file.
+    def save(self):
+        if self.reportFile is None:
+            return
+        with open(self.reportFile, 'w', encoding='utf-8') as rf:
+            json.dump(self.getReport(), rf, indent=2)
+
+class StageTimer:
+    def __init__(self, metrics, stage, bytesProcessed=0, calls=1):
+        self.metrics = metrics
+        self.stage = stage
+        self.bytesProcessed = bytesProcessed
+        self.calls = calls
+
+    def __enter__(self):
+        self.startTime = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.startTime, self.bytesProcessed, self.calls)
+        return False
+
+# Times the stages of a single song. Timings are a plain dictionary, so worker processes can return them
+# with the song outcome: {stage: (seconds, bytes processed)}
+class SongTimer:
+    def __init__(self):
+        self.timings = {}
+        self.startTime = time.perf_counter()
+
+    # Ends the current stage and starts the next one
+    def lap(self, stage, bytesProcessed=0):
+        now = time.perf_counter()
+        seconds, previousBytes = self.timings.get(stage, (0.0, 0))
+        self.timings[stage] = (seconds + now - self.startTime, previousBytes + bytesProcessed)
+        self.startTime = now
+
+    def getTimings(self):
+        return self.timings
+
+# Formats seconds as h:mm:ss, for progress messages
+def formatDuration(seconds):
+    seconds = int(round(seconds))
+    return str(seconds // 3600) + ':' + str(seconds // 60 % 60).zfill(2) + ':' + str(seconds % 60).zfill(2)
@@ -0,0 +1,289 @@
+## resources.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## PROCESS-WIDE LOADING OF THE SONG DATASET AND THE INVERTED INDEXES
+
+import collections
+import os
+import pickle
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from bm25index import BM25Index, SortedVocabulary, loadIndexes, unifiedIndexName
+from catalog import SongCatalog
+from expansion import QueryExpander
+
+songFile  = 'music.csv'
+lyricsFile = 'lyrics.bin'       # Lyrics of all songs, read only when the lyrics of a song are asked for
+indexFile = 'bm25.idx'          # Binary index file written by dataprep.py, memory-mapped
+legacyIndexFile = 'bm25.pkl'    # Pickled indexes written by older versions of dataprep.py
+
+queryCacheSize = 10000          # Query results kept in memory by each process
+queryCacheTTL = 3600            # Seconds a query result is kept
+
+# Streamlit re-executes app.py on every interaction, but imported modules stay loaded for the life
+# of the server process. Keeping the loaded artifacts here means they are read from disk once per
+# process and shared (read-only) by every session, instead of once per rerun.
+_lock = threading.Lock()
+_current = None
+
+# Least recently used cache of query results, shared by all sessions of a process. Results are kept
+# for at most ttl seconds and the least recently used ones are evicted once maxSize results are cached.
+# hits, misses, evictions (for size) and expirations (for age) are counted to help size the cache.
+class QueryCache:
+    def __init__(self, maxSize=queryCacheSize, ttl=queryCacheTTL):
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()    # key -> (time stored, value), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Returns the cached value of key, or None if it is not cached or expired
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def getStats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'maxSize': self.maxSize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hitRate': self.hits / lookups if lookups > 0 else 0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
+
+# Holds everything the web application needs to answer queries. Treat it as read-only: the same
+# instance is handed to every session until the artifact files change on disk.
+# Each instance has its own query cache, so cached results are dropped when new artifacts are loaded.
+# Query terms that are not in the index are expanded with queryExpander (prefix completions and spelling
+# corrections), when the index of all songs was read from an index file.
+class Resources:
+    def __init__(self, catalog, indexes, signature, loadTime, memoryFootprint, mappedBytes):
+        self.catalog = catalog                  # Song metadata addressed by song id (music.csv)
+        self.indexes = indexes                  # Inverted index of all songs, or one for each mood in older files (bm25.idx)
+        self.signature = signature              # (mtime, size) of each artifact when it was loaded
+        self.loadTime = loadTime                # Seconds spent reading the artifacts from disk
+        self.memoryFootprint = memoryFootprint  # Approximate bytes held by the loaded artifacts, excluding mapped files
+        self.mappedBytes = mappedBytes          # Bytes of memory-mapped files. Only pages that are used become resident
+        self.queryCache = QueryCache()
+        self.queryExpander = None
+        unifiedIndex = indexes.get(unifiedIndexName)
+        if unifiedIndex is not None and isinstance(unifiedIndex.vocabulary, SortedVocabulary):
+            self.queryExpander = QueryExpander(unifiedIndex)
+
+    # Returns (song ids, scores) of the best k songs of a mood, or of any of a list of moods, for a
+    # tokenized query, from the query cache when possible. Returned arrays are shared between sessions
+    # and must not be modified. With expand, misspelled and partially typed terms are expanded first.
+    # Results of queries whose expansion ran out of time are not cached.
+    def search(self, moods, tokenizedQuery, k=10, expand=True):
+        moods = normalizeMoods(moods)
+        key = (moods, tuple(tokenizedQuery), k, expand)
+        results = self.queryCache.get(key)
+        if results is None:
+            terms, weights, complete = self.expandQuery(tokenizedQuery) if expand else (tokenizedQuery, None, True)
+            songIds, scores = self.searchIndexes(moods, terms, k, weights)
+            songIds.setflags(write=False)
+            scores.setflags(write=False)
+            results = (songIds, scores)
+            if complete:
+                self.queryCache.put(key, results)
+        return results
+
+    # Returns (terms, weights, complete) for a tokenized query: see QueryExpander.expandQuery(). Queries
+    # are not expanded if the index has no sorted vocabulary (index files written before bm25.idx).
+    def expandQuery(self, tokenizedQuery):
+        if self.queryExpander is None:
+            return list(tokenizedQuery), None, True
+        return self.queryExpander.expandQuery(tokenizedQuery)
+
+    # Same as search(), without the query cache and query expansion. weights has a weight for each term,
+    # and songMask limits results to the songs where it is True.
+    def searchIndexes(self, moods, tokenizedQuery, k=10, weights=None, songMask=None):
+        moods = normalizeMoods(moods)
+        if unifiedIndexName in self.indexes:
+            return self.indexes[unifiedIndexName].getTopN(tokenizedQuery, n=k, moods=moods, weights=weights, songMask=songMask)
+
+        # Older index files have one index per mood. Their scores use the idf of each mood, so results
+        # of several moods are only merged by score.
+        results = [self.indexes[mood].getTopN(tokenizedQuery, n=k, weights=weights, songMask=songMask) for mood in moods]
+        songIds = np.concatenate([songIds for songIds, _ in results])
+        scores = np.concatenate([scores for _, scores in results])
+        order = np.lexsort((songIds, -scores))[:k]
+        return songIds[order], scores[order]
+
+    # Returns (song ids, scores) of the best k songs whose compound is between low and high, for a tokenized
+    # query. Without target, songs are ranked by BM25 score. With target, songs closest to the target
+    # compound come first, and songs as close as each other are ranked by BM25 score. A query without
+    # tokens matches every song of the range (score 0), closest to target (or to the middle of the range) first.
+    # The songs of the range come from the compound index of the catalog. Results are cached as in search().
+    def searchCompound(self, low, high, tokenizedQuery, k=10, target=None, expand=True):
+        if self.catalog.compoundIndex is None:
+            raise ValueError('The song database has no compound scores. Run the data preparation script to add them.')
+        key = ('compound', float(low), float(high), None if target is None else float(target), tuple(tokenizedQuery), k, expand)
+        results = self.queryCache.get(key)
+        if results is not None:
+            return results
+
+        terms, weights, complete = self.expandQuery(tokenizedQuery) if expand else (tokenizedQuery, None, True)
+        compoundIndex = self.catalog.compoundIndex
+        if len(terms) == 0:
+            songIds = compoundIndex.getClosest((low + high) / 2 if target is None else target, k, low, high)
+            scores = np.zeros(len(songIds), dtype=np.float64)
+        else:
+            songMask = np.zeros(len(self.catalog), dtype=bool)
+            songMask[compoundIndex.getRange(low, high)] = True
+            if target is None:
+                songIds, scores = self.searchIndexes(range(1, 6), terms, k, weights, songMask)
+            else:
+                songIds, scores = self.getIndexScores(terms, weights, songMask)
+                distances = np.abs(self.catalog.compounds[songIds] - target)
+                order = np.lexsort((songIds, -scores, distances))[:k]
+                songIds, scores = songIds[order], scores[order]
+
+        songIds.setflags(write=False)
+        scores.setflags(write=False)
+        results = (songIds, scores)
+        if complete:
+            self.queryCache.put(key, results)
+        return results
+
+    # Returns (song ids, scores) of every song of songMask that contains a query term, in no particular order
+    def getIndexScores(self, tokenizedQuery, weights, songMask):
+        results = []
+        for index in self.indexes.values():
+            docIds, scores = index.getScores(tokenizedQuery, weights=weights, songMask=songMask)
+            results.append((index.songIds[docIds], scores))
+        return np.concatenate([songIds for songIds, _ in results]), np.concatenate([scores for _, scores in results])
+
+# Sorted tuple of distinct moods, from a mood or a collection of moods. Used as the mood part of query cache
+# keys, so the same moods in another order share cached results. Moods are validated by retrieval.py.
+def normalizeMoods(moods):
+    if isinstance(moods, (int, np.integer)):
+        return (int(moods),)
+    return tuple(sorted(set(int(mood) for mood in moods)))
+
+# Returns (modification time, size) of a file. Used to detect when an artifact was rebuilt
+def getFileSignature(path):
+    fileStat = os.stat(path)
+    return (fileStat.st_mtime_ns, fileStat.st_size)
+
+# Approximates the memory held by an object, following containers and object attributes
+def getObjectSize(obj, seen=None):
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    if isinstance(obj, pd.DataFrame):
+        return int(obj.memory_usage(index=True, deep=True).sum())
+    if isinstance(obj, np.ndarray):
+        if isMemoryMapped(obj):
+            return 0
+        size = sys.getsizeof(obj) if obj.base is None else obj.nbytes
+        if obj.dtype == object:
+            size += sum(getObjectSize(item, seen) for item in obj.flat)
+        return size
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(getObjectSize(key, seen) + getObjectSize(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(getObjectSize(item, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += getObjectSize(vars(obj), seen)
+    return size
+
+# Determines if an array is a view of a memory-mapped file
+def isMemoryMapped(array):
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return False
+
+# Returns the index file in use: bm25.idx, or bm25.pkl if only an older index file is available
+def getIndexFile():
+    if os.path.isfile(indexFile) or not os.path.isfile(legacyIndexFile):
+        return indexFile
+    return legacyIndexFile
+
+# Columns of music.csv that are not loaded: lyrics (in music.csv files written before lyrics.bin existed)
+# and the compound of every scope written with --compare-scopes
+def isLoadedColumn(column):
+    return column != 'lyrics' and not column.startswith('compound_')
+
+# Reads music.csv and opens the index file
+def loadResources(signature):
+    startTime = time.perf_counter()
+
+    songs = pd.read_csv(songFile, usecols=isLoadedColumn)
+    catalog = SongCatalog.fromDataFrame(songs, lyricsFile)
+    del songs
+    currentIndexFile = getIndexFile()
+    mappedBytes = 0 if catalog.lyricsData is None else len(catalog.lyricsData)
+    if currentIndexFile == indexFile:
+        indexes = loadIndexes(indexFile)
+        mappedBytes += os.path.getsize(indexFile)
+    else:
+        with open(legacyIndexFile, 'rb') as tf:
+            indexes = pickle.load(tf)
+
+    # Index files written before BM25Index existed hold rank_bm25 BM25Okapi objects, one for each mood.
+    # Their documents are the songs of each mood in music.csv order.
+    for mood, index in indexes.items():
+        if not isinstance(index, BM25Index):
+            indexes[mood] = BM25Index.fromOkapi(index, catalog.getSongIds(mood))
+
+    loadTime = time.perf_counter() - startTime
+    memoryFootprint = getObjectSize(catalog) + getObjectSize(indexes)
+
+    print('Loaded', songFile, 'and', currentIndexFile, 'in', str(round(loadTime, 3)), 'seconds',
+          '(about ' + str(round(memoryFootprint / 1024 / 1024, 1)) + ' MB in memory, ' + str(round(mappedBytes / 1024 / 1024, 1)) + ' MB mapped).')
+
+    return Resources(catalog, indexes, signature, loadTime, memoryFootprint, mappedBytes)
+
+# Returns the resources shared by all sessions of this process. Artifacts are only read again
+# when music.csv, lyrics.bin or the index file changed on disk since they were last loaded.
+def getResources():
+    global _current
+
+    signature = (getFileSignature(songFile), getFileSignature(lyricsFile) if os.path.isfile(lyricsFile) else None, getFileSignature(getIndexFile()))
+    resources = _current
+    if resources is not None and resources.signature == signature:
+        return resources
+
+    with _lock:
+        # Another session may have reloaded the artifacts while we waited for the lock
+        if _current is None or _current.signature != signature:
+            _current = loadResources(signature)
+        return _current
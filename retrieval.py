@@ -0,0 +1,128 @@
+## retrieval.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## SONG RETRIEVAL CORE SHARED BY THE WEB APPLICATION AND THE HTTP SERVER
+
+import numbers
+
+from resources import getResources
+from tokenization import getQueryTokenizer
+
+# Moods 1 to 5, as selected with the face buttons of the web application
+moodNames = ['very sad', 'sad', 'neutral', 'happy', 'very happy']
+
+defaultResultCount = 10
+maxResultCount = 100
+maxCandidateCount = 100     # Best songs of a query kept for its pages: songs ranked lower are not shown
+
+# Splits the keywords typed by the user into query tokens with the tokenizer rules of the index (see
+# createIndexes()): lowercase, and only alphabetic tokens (spaCy's is_alpha) kept. Contractions and slang are
+# split as in the lyrics ("don't" -> 'do', "gonna" -> 'gon', 'na'), punctuation and hyphens separate words,
+# and words with digits or underscores are left out.
+def tokenizeQuery(query):
+    return [token.text for token in getQueryTokenizer()(query.lower()) if token.is_alpha]
+
+# Checks the mood (a mood from 1 to 5, or a list of moods) and the number of results of a search.
+# Returns the list of moods.
+def getSearchMoods(mood, k):
+    moods = [mood] if isinstance(mood, numbers.Integral) else list(mood)
+    if len(moods) == 0 or any(m not in range(1, len(moodNames) + 1) for m in moods):
+        raise ValueError('Invalid mood: ' + str(mood) + '. Expected moods from 1 to ' + str(len(moodNames)) + '.')
+    if k < 1 or k > maxResultCount:
+        raise ValueError('Invalid number of results: ' + str(k) + '. Expected a number from 1 to ' + str(maxResultCount) + '.')
+    return moods
+
+# Returns the best songs of a mood, or of any of a list of moods (e.g. [1, 2] for sad or very sad), for the
+# keywords of a query, as a list of dictionaries: rank, id, title, artist, album, mood, compound, score,
+# link, explicit (the title has profanity) and censored (the title was censored). With censor, titles with
+# profanity are censored. Censored titles and links are read from the song database, not computed here.
+# Only songs that contain at least one of the keywords are returned, so there may be fewer than k songs.
+def searchSongs(mood, query, k=defaultResultCount, censor=True, resources=None):
+    moods = getSearchMoods(mood, k)
+    if resources is None:
+        resources = getResources()
+
+    # Results are song ids, best first. Frequent keyword and mood combinations come from the query cache.
+    songIds, scores = resources.search(moods, tokenizeQuery(query), k)
+    return getSongResults(resources.catalog, songIds, scores, censor)
+
+# The best songs of a query, scored once and then shown one page at a time. Only the song ids and scores
+# of the candidates are kept (at most maxCandidateCount songs), and the fields of a page are looked up
+# when the page is shown, so pages after the first take no scoring. The catalog the songs were retrieved
+# from is kept with them, so pages stay consistent if new files are loaded in the meantime.
+class ResultPages:
+    def __init__(self, catalog, songIds, scores, pageSize=defaultResultCount, censor=True):
+        self.catalog = catalog
+        self.songIds = songIds
+        self.scores = scores
+        self.pageSize = pageSize
+        self.censor = censor
+
+    def __len__(self):
+        return len(self.songIds)
+
+    # Number of pages, at least 1 (an empty page if no songs matched)
+    def getPageCount(self):
+        return max(1, -(-len(self.songIds) // self.pageSize))
+
+    # Songs of a page (from 1), as searchSongs() returns them. The last page may have fewer songs.
+    def getPage(self, page):
+        if page < 1 or page > self.getPageCount():
+            raise ValueError('Invalid page: ' + str(page) + '. Expected a page from 1 to ' + str(self.getPageCount()) + '.')
+        start = (page - 1) * self.pageSize
+        end = start + self.pageSize
+        return getSongResults(self.catalog, self.songIds[start:end], self.scores[start:end], self.censor, start + 1)
+
+# Returns the ResultPages of the best songs of a mood (or moods) for the keywords of a query, with
+# pageSize songs per page. Candidates come from the query cache shared by all sessions, so the same
+# query on another session is not scored again either.
+def searchPages(mood, query, pageSize=defaultResultCount, censor=True, resources=None):
+    moods = getSearchMoods(mood, pageSize)
+    if resources is None:
+        resources = getResources()
+
+    songIds, scores = resources.search(moods, tokenizeQuery(query), maxCandidateCount)
+    return ResultPages(resources.catalog, songIds, scores, pageSize, censor)
+
+# Returns the songs whose compound sentiment score is between low and high (from -1, very negative, to 1,
+# very positive), for the keywords of a query, as searchSongs() does. Without target, the songs that best
+# match the keywords come first. With target, songs whose compound is closest to target come first
+# (e.g. low=-1, high=1, target=0.3 for songs closest to a mildly happy mood). Without keywords, every song
+# of the range matches, closest to target (or to the middle of the range) first.
+def searchSongsByCompound(low, high, query, k=defaultResultCount, censor=True, resources=None, target=None):
+    if not -1 <= low <= high <= 1:
+        raise ValueError('Invalid compound range: ' + str(low) + ' to ' + str(high) + '. Expected -1 <= low <= high <= 1.')
+    if target is not None and not -1 <= target <= 1:
+        raise ValueError('Invalid target compound: ' + str(target) + '. Expected a number from -1 to 1.')
+    if k < 1 or k > maxResultCount:
+        raise ValueError('Invalid number of results: ' + str(k) + '. Expected a number from 1 to ' + str(maxResultCount) + '.')
+    if resources is None:
+        resources = getResources()
+
+    songIds, scores = resources.searchCompound(low, high, tokenizeQuery(query), k, target)
+    return getSongResults(resources.catalog, songIds, scores, censor)
+
+# Looks up the fields of retrieved songs, in rank order. firstRank is the rank of the first song.
+def getSongResults(catalog, songIds, scores, censor, firstRank=1):
+    songs = []
+    for rank, (songId, score) in enumerate(zip(songIds, scores), firstRank):
+        displayTitle, explicit, link = catalog.getDisplayFields(songId)
+        songs.append({
+            'rank': rank,
+            'id': int(songId),
+            'title': displayTitle if censor else catalog.titles[songId],
+            'artist': catalog.artists[songId],
+            'album': catalog.albums[songId],
+            'mood': int(catalog.sentiments[songId]),
+            'compound': catalog.getCompound(songId),
+            'score': float(score),
+            'link': link,
+            'explicit': explicit,
+            'censored': censor and explicit
+        })
+    return songs
+
+# Answers many (mood, query) pairs at once (mood can also be a list of moods), with the artifacts loaded a single time for the batch.
+# Returns one list of songs per pair, in order.
+def searchBatch(queries, k=defaultResultCount, censor=True):
+    resources = getResources()
+    return [searchSongs(mood, query, k, censor, resources) for mood, query in queries]
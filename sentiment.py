@@ -0,0 +1,91 @@
+## sentiment.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## VADER SENTIMENT SCORING OF SONG LYRICS WITH A SHARED LEXICON AND A SEGMENT CACHE
+
+import numpy as np
+
+from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+acceptedScopes = ['full', 'verse', 'line']
+
+# Splits lyrics into the segments scored for each scope:
+# 'full' : the whole lyrics at once
+# 'verse': each verse (block of lines followed by an empty line)
+# 'line' : each non-empty line
+def getSegments(lyrics, scope):
+    if scope == 'full':
+        return [lyrics]
+
+    segments = []
+    if scope == 'verse':
+        linecounter = 0
+        paragraph = ''
+        for line in lyrics.splitlines():
+            if line.strip() == '':
+                if linecounter > 0:
+                    segments.append(paragraph)
+                    linecounter = 0
+                    paragraph = ''
+            else:
+                paragraph = paragraph + line + '\n'
+                linecounter += 1
+
+    elif scope == 'line':
+        for line in lyrics.splitlines():
+            if len(line.strip()) > 0:
+                segments.append(line)
+
+    return segments
+
+# Scores lyrics with a single SentimentIntensityAnalyzer, so the VADER lexicon is read once instead of
+# once per verse or line. Compound scores of verses and lines are cached by segment text: choruses and
+# repeated lines are very common in lyrics and are only scored once, across all songs handled by this
+# scorer. Whole lyrics ('full' scope) are not cached, as they do not repeat.
+class SentimentScorer:
+    def __init__(self, maxCachedSegments=100000):
+        self.analyzer = SentimentIntensityAnalyzer()
+        self.maxCachedSegments = maxCachedSegments
+        self.cache = {}
+        self.cacheHits = 0
+        self.cacheMisses = 0
+
+    # Compound score of a single segment. With cached False, the segment is scored without the cache.
+    def getCompound(self, segment, cached=True):
+        if not cached:
+            return self.analyzer.polarity_scores(segment)['compound']
+        compound = self.cache.get(segment)
+        if compound is not None:
+            self.cacheHits += 1
+            return compound
+
+        self.cacheMisses += 1
+        compound = self.analyzer.polarity_scores(segment)['compound']
+        if len(self.cache) >= self.maxCachedSegments:
+            self.cache.clear()
+        self.cache[segment] = compound
+        return compound
+
+    # Mean compound of lyrics for each scope. Verses without sentiment (compound 0) are not counted in
+    # the 'verse' average, as they would pull every song towards neutral.
+    # Returns {scope: mean compound}, 0 when there is nothing to score.
+    def scoreLyrics(self, lyrics, scopes=acceptedScopes):
+        meanCompounds = {}
+        for scope in scopes:
+            compounds = [self.getCompound(segment, scope != 'full') for segment in getSegments(lyrics, scope)]
+            if scope == 'verse':
+                compounds = [compound for compound in compounds if compound != 0]
+
+            meanCompound = 0
+            if len(compounds) > 0:
+                meanCompound = np.mean(compounds)
+            meanCompounds[scope] = meanCompound
+        return meanCompounds
+
+# One scorer per process. Worker processes of dataprep.py each create their own the first time they score a song.
+_scorer = None
+
+def getScorer():
+    global _scorer
+    if _scorer is None:
+        _scorer = SentimentScorer()
+    return _scorer
@@ -0,0 +1,197 @@
+## server.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## LOCAL HTTP/JSON SERVER FOR SONG RETRIEVAL, WITHOUT THE WEB APPLICATION
+
+import json
+import sys
+import traceback
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from resources import getResources
+from retrieval import defaultResultCount, searchPages, searchSongs, searchSongsByCompound
+
+defaultHost = '127.0.0.1'
+defaultPort = 8510
+maxBatchSize = 1000             # (mood, query) pairs accepted in a single batch request
+maxRequestBytes = 1024 * 1024   # Largest request body accepted
+
+# Reads the mood of a request: a number, a list of numbers, or numbers separated by commas ('1,2').
+# Moods are validated by the search, see getSearchMoods() in retrieval.py
+def parseMoods(value):
+    if isinstance(value, list):
+        return [int(mood) for mood in value]
+    if isinstance(value, str) and ',' in value:
+        return [int(mood) for mood in value.split(',')]
+    return int(value)
+
+# Reads the keywords of a JSON request, which must be a string
+def getQuery(request):
+    query = request.get('query', '')
+    if not isinstance(query, str):
+        raise ValueError('Expected "query" with a string of keywords.')
+    return query
+
+# Reads the compound range and optional target of a request to /compound
+def getCompoundRange(parameters):
+    target = parameters.get('target')
+    return float(parameters.get('min', -1)), float(parameters.get('max', 1)), None if target is None else float(target)
+
+# Reads the optional parameters shared by all search requests
+def getSearchOptions(parameters):
+    k = int(parameters.get('k', defaultResultCount))
+    censor = parameters.get('censor', True)
+    if isinstance(censor, str):
+        censor = censor.lower() not in ['0', 'false', 'no']
+    return k, bool(censor)
+
+# Answers a search request: the best k songs, or with "page", page of k songs of the best songs, with the
+# number of pages and of songs found. Pages after the first come from the query cache, without scoring songs again.
+def getSearchResponse(parameters, query):
+    k, censor = getSearchOptions(parameters)
+    moods = parseMoods(parameters.get('mood', 0))
+    if parameters.get('page') is None:
+        return {'songs': searchSongs(moods, query, k, censor)}
+    page = int(parameters.get('page'))
+    resultPages = searchPages(moods, query, k, censor)
+    return {'songs': resultPages.getPage(page), 'page': page, 'pages': resultPages.getPageCount(), 'total': len(resultPages)}
+
+# Endpoints:
+# GET  /search?mood=1&q=keywords[&k=10][&censor=1][&page=1]
+#               Best songs of a mood (or moods: mood=1,2) for the keywords. With page, songs of that page
+#               of k songs, with the number of pages and songs found ("page", "pages" and "total").
+# POST /search  {"mood": 1, "query": "keywords", "k": 10, "censor": true, "page": 1}  ("mood": [1, 2] for several moods)
+# GET  /compound?min=-0.2&max=0.2[&target=0][&q=keywords][&k=10][&censor=1]
+#               Best songs whose compound sentiment score is between min and max (default -1 and 1),
+#               closest to target first if given. Without keywords, every song of the range matches.
+# POST /compound  {"min": -0.2, "max": 0.2, "target": 0, "query": "keywords", "k": 10, "censor": true}
+# POST /batch   {"queries": [{"mood": 1, "query": "keywords"}, ...], "k": 10, "censor": true}
+#               Answers many (mood, query) pairs in one request. A pair that is not valid gets an
+#               "error" instead of "songs", without failing the other pairs.
+# GET  /health  Number of songs, load time, and query cache and query expansion statistics
+# Responses are JSON. Invalid requests get status 400 and {"error": message}, and requests that fail
+# for another reason (e.g. the song database is missing) get status 500 and {"error": message}.
+class RetrievalHandler(BaseHTTPRequestHandler):
+    logRequests = False
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        parameters = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            if url.path == '/search':
+                self.sendJson(200, getSearchResponse(parameters, parameters.get('q', '')))
+            elif url.path == '/compound':
+                k, censor = getSearchOptions(parameters)
+                low, high, target = getCompoundRange(parameters)
+                self.sendJson(200, {'songs': searchSongsByCompound(low, high, parameters.get('q', ''), k, censor, target=target)})
+            elif url.path == '/health':
+                resources = getResources()
+                self.sendJson(200, {
+                    'songs': len(resources.catalog),
+                    'loadTime': resources.loadTime,
+                    'queryCache': resources.queryCache.getStats(),
+                    'queryExpansion': resources.queryExpander.getStats() if resources.queryExpander is not None else None
+                })
+            else:
+                self.sendJson(404, {'error': 'Not found: ' + url.path})
+        except (ValueError, TypeError) as e:
+            self.sendJson(400, {'error': str(e)})
+        except Exception as e:
+            self.sendServerError(e)
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        try:
+            request = self.readJson()
+            if url.path == '/search':
+                self.sendJson(200, getSearchResponse(request, getQuery(request)))
+            elif url.path == '/compound':
+                k, censor = getSearchOptions(request)
+                low, high, target = getCompoundRange(request)
+                self.sendJson(200, {'songs': searchSongsByCompound(low, high, getQuery(request), k, censor, target=target)})
+            elif url.path == '/batch':
+                queries = request.get('queries')
+                if not isinstance(queries, list) or len(queries) > maxBatchSize:
+                    raise ValueError('Expected "queries" with a list of up to ' + str(maxBatchSize) + ' {"mood", "query"} objects.')
+                k, censor = getSearchOptions(request)
+                resources = getResources()
+                results = []
+                for pair in queries:
+                    if not isinstance(pair, dict):
+                        results.append({'error': 'Expected a {"mood", "query"} object.'})
+                        continue
+                    result = {'mood': pair.get('mood'), 'query': pair.get('query')}
+                    try:
+                        result['songs'] = searchSongs(parseMoods(pair.get('mood', 0)), getQuery(pair), k, censor, resources)
+                    except (ValueError, TypeError) as e:
+                        result['error'] = str(e)
+                    results.append(result)
+                self.sendJson(200, {'results': results})
+            else:
+                self.sendJson(404, {'error': 'Not found: ' + url.path})
+        except (ValueError, TypeError) as e:
+            self.sendJson(400, {'error': str(e)})
+        except Exception as e:
+            self.sendServerError(e)
+
+    def readJson(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length > maxRequestBytes:
+            raise ValueError('Request body is larger than ' + str(maxRequestBytes) + ' bytes.')
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(request, dict):
+            raise ValueError('Expected a JSON object.')
+        return request
+
+    # Answers a request that failed for a reason other than the request itself (e.g. music.csv is missing)
+    # with status 500, instead of dropping the connection. The error is printed for the server log.
+    def sendServerError(self, error):
+        traceback.print_exc()
+        self.sendJson(500, {'error': 'Internal server error: ' + str(error)})
+
+    def sendJson(self, status, response):
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Requests are only logged with --log, as logging every request slows down load tests
+    def log_message(self, format, *args):
+        if self.logRequests:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+# Usage: python server.py [--host 127.0.0.1] [--port 8510] [--log]
+# Run it from the directory with music.csv and bm25.idx, as the web application.
+if __name__ == '__main__':
+    host = defaultHost
+    port = defaultPort
+
+    args = sys.argv[1:]
+    while len(args) > 0:
+        arg = args.pop(0)
+        if arg == '--log':
+            RetrievalHandler.logRequests = True
+        elif arg in ['--host', '--port'] and len(args) > 0:
+            value = args.pop(0)
+            if arg == '--host':
+                host = value
+            elif not value.isdigit():
+                raise Exception("Invalid value for --port argument. Expected a port number.")
+            else:
+                port = int(value)
+        else:
+            raise Exception("Invalid argument: " + arg)
+
+    # Load the song database and indexes before accepting requests
+    getResources()
+    server = ThreadingHTTPServer((host, port), RetrievalHandler)
+    print('Serving song retrieval on http://' + host + ':' + str(port) + ' (endpoints: /search, /compound, /batch, /health)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
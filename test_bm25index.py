@@ -0,0 +1,81 @@
+## test_bm25index.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## TESTS OF THE BM25 INDEX AGAINST RANK_BM25 AND OF THE INDEX FILE
+
+import os
+import random
+import tempfile
+import unittest
+
+import numpy as np
+from rank_bm25 import BM25Okapi
+
+from bm25index import BM25Index, loadIndexes, saveIndexes, unifiedIndexName
+
+# Small corpus with frequent terms (negative idf, replaced by epsilon), rare terms and an empty document
+def getCorpus(documentCount=200, seed=0):
+    rng = random.Random(seed)
+    words = ['love', 'baby', 'night', 'heart', 'rain', 'fire', 'dance', 'home', 'road', 'blue', 'gon', 'na']
+    words += ['rare' + str(i) for i in range(30)]
+    frequent = ['the', 'you']
+    corpus = []
+    for docId in range(documentCount):
+        length = 0 if docId == 7 else rng.randint(1, 40)
+        corpus.append([rng.choice(frequent) if rng.random() < 0.3 else rng.choice(words) for _ in range(length)])
+    return corpus
+
+queries = [['love'], ['love', 'rain'], ['the', 'heart'], ['rain', 'rain', 'fire'], ['rare3', 'rare17'], ['gon', 'na', 'dance'], ['unknown', 'home']]
+
+class BM25IndexTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.corpus = getCorpus()
+        cls.moods = np.array([docId % 5 + 1 for docId in range(len(cls.corpus))], dtype=np.int8)
+        cls.okapi = BM25Okapi(cls.corpus)
+        cls.index = BM25Index.build(cls.corpus, moods=cls.moods)
+
+    # Scores of every document, with 0 for the documents not returned by getScores()
+    def getAllScores(self, index, query, moods=None):
+        docIds, scores = index.getScores(query, moods=moods)
+        allScores = np.zeros(len(self.corpus))
+        allScores[docIds] = scores
+        return allScores
+
+    def test_scores_match_okapi(self):
+        for query in queries:
+            np.testing.assert_allclose(self.getAllScores(self.index, query), self.okapi.get_scores(query), rtol=1e-12, atol=1e-12, err_msg=str(query))
+
+    def test_top_n_matches_okapi(self):
+        for query in queries:
+            expected = self.okapi.get_scores(query)
+            order = np.lexsort((np.arange(len(expected)), -expected))
+            order = order[expected[order] > 0][:10]
+            songIds, scores = self.index.getTopN(query, n=10)
+            self.assertEqual(songIds.tolist(), order.tolist(), query)
+            np.testing.assert_allclose(scores, expected[order], rtol=1e-12)
+
+    def test_moods_filter_okapi_scores(self):
+        for query in queries:
+            expected = self.okapi.get_scores(query)
+            expected[~np.isin(self.moods, [2, 4])] = 0
+            np.testing.assert_allclose(self.getAllScores(self.index, query, moods=[2, 4]), expected, rtol=1e-12, atol=1e-12, err_msg=str(query))
+
+    def test_index_file_rebuilds_byte_identical(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first = os.path.join(directory, 'first.idx')
+            second = os.path.join(directory, 'second.idx')
+            saveIndexes(first, {unifiedIndexName: self.index})
+            saveIndexes(second, {unifiedIndexName: BM25Index.build(self.corpus, moods=self.moods)})
+            with open(first, 'rb') as f, open(second, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+            # An index read from its file scores the same and is written back unchanged
+            loaded = loadIndexes(first, mapped=False)
+            for query in queries:
+                np.testing.assert_allclose(self.getAllScores(loaded[unifiedIndexName], query), self.okapi.get_scores(query), rtol=1e-12, atol=1e-12)
+            saveIndexes(second, loaded)
+            with open(first, 'rb') as f, open(second, 'rb') as g:
+                self.assertEqual(f.read(), g.read())
+
+if __name__ == '__main__':
+    unittest.main()
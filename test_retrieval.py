@@ -0,0 +1,43 @@
+## test_retrieval.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## TESTS OF THE TOKENIZATION OF QUERIES
+
+import unittest
+
+import spacy
+
+from retrieval import tokenizeQuery
+from tokenization import loadTokenizer
+
+# Lyric lines with contractions, slang, curly apostrophes, hyphens and punctuation
+sampleLines = [
+    "I'm gonna love you 'til the end of time",
+    "You gotta fight for your right to party!",
+    "'Cause I don't wanna miss a thing",
+    "Let 'em say what they want, we ain't gonna stop",
+    "She’s a well-known rock ’n’ roll queen",
+    "Hey, hey... (ooh-la-la) it's 24/7, baby",
+    "Y'all can't touch this; lovin' every minute",
+    "WE WILL, WE WILL ROCK YOU",
+]
+
+class TokenizeQueryTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The tokenizer of the index, or spaCy's English tokenizer when the English model is not installed
+        try:
+            cls.nlp = loadTokenizer()
+        except OSError:
+            cls.nlp = spacy.blank('en')
+
+    def test_matches_index_tokens(self):
+        for line in sampleLines:
+            indexTokens = [token.text for token in self.nlp(line.lower()) if token.is_alpha]
+            self.assertEqual(tokenizeQuery(line), indexTokens, line)
+
+    def test_splits_slang_like_the_index(self):
+        self.assertEqual(tokenizeQuery('Gonna'), ['gon', 'na'])
+        self.assertEqual(tokenizeQuery("don't stop"), ['do', 'stop'])
+
+if __name__ == '__main__':
+    unittest.main()
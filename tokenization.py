@@ -0,0 +1,107 @@
+## tokenization.py
+## Authors: Gunther Bacellar and Pericles Rocha
+## TOKENIZATION OF LYRICS FOR THE REVERSE INDEX, WITH A CACHE OF TOKENS BY CONTENT HASH
+
+import hashlib
+import importlib.metadata
+import os
+
+import numpy as np
+import spacy
+
+tokenCacheFile = 'tokens.cache'     # Tokens of every indexed song from the last index build
+tokenCacheVersion = 1
+spacyModel = 'en_core_web_sm'
+minTextsPerProcess = 1000           # Fewer texts per process than this are tokenized faster in a single process
+
+# Text of a song as it is indexed: the title followed by the lyrics, lowercased
+def getDocumentText(title, lyrics):
+    return (str(title) + '\n' + lyrics).lower()
+
+def getTextHash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+# Versions of spaCy and of its English model: tokens cached with other versions are not reused, as
+# tokenization rules may have changed. Versions are read from the installed packages, which works with
+# spaCy 2 and 3 alike.
+def getTokenizerSignature():
+    try:
+        modelVersion = importlib.metadata.version(spacyModel)
+    except importlib.metadata.PackageNotFoundError:
+        modelVersion = None
+    return spacyModel + ' ' + str(modelVersion) + ' spacy ' + spacy.about.__version__
+
+# Loads the English model of spaCy with its tokenizer only. Tokens and their is_alpha attribute come from
+# the tokenizer and the vocabulary: tagger, parser and named entities do not change them, so they are not run.
+def loadTokenizer():
+    nlp = spacy.load(spacyModel)
+    for name in list(nlp.pipe_names):
+        nlp.remove_pipe(name)
+    return nlp
+
+# spaCy's English tokenizer without a model, for the keywords of queries. The English model used by
+# loadTokenizer() tokenizes with these same rules, so the web application and the server tokenize queries
+# like the index without installing the model. Created on first use.
+queryTokenizer = None
+
+def getQueryTokenizer():
+    global queryTokenizer
+    if queryTokenizer is None:
+        queryTokenizer = spacy.blank('en').tokenizer
+    return queryTokenizer
+
+# Tokenizes texts with spaCy, keeping alphabetic tokens only. With several workers, texts are split across
+# processes by nlp.pipe.
+def tokenizeTexts(nlp, texts, workers=1, batchSize=256):
+    processes = max(1, min(workers, len(texts) // minTextsPerProcess))
+    return [[token.text for token in doc if token.is_alpha] for doc in nlp.pipe(texts, n_process=processes, batch_size=batchSize)]
+
+# Tokens of the songs indexed by the last index build, by hash of the song text (see getDocumentText).
+# The file stores each distinct token once, and the tokens of each song as token ids: rebuilding the
+# index with other BM25 parameters, or after a few songs changed, only tokenizes the songs whose text
+# is not in the cache.
+class TokenCache:
+    def __init__(self, hashes, docOffsets, tokenIds, terms):
+        self.positions = {textHash: position for position, textHash in enumerate(hashes)}
+        self.docOffsets = docOffsets
+        self.tokenIds = tokenIds
+        self.terms = terms      # Object array, to look up the tokens of a song with a single index operation
+
+    def __len__(self):
+        return len(self.positions)
+
+    # Tokens of a song text, or None if it is not in the cache
+    def get(self, textHash):
+        position = self.positions.get(textHash)
+        if position is None:
+            return None
+        return self.terms[self.tokenIds[self.docOffsets[position]:self.docOffsets[position + 1]]].tolist()
+
+    # Reads a token cache file. Returns an empty cache if the file does not exist, or if it was written by
+    # another version of this file format or of the tokenizer.
+    @classmethod
+    def load(cls, path, signature):
+        empty = cls([], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int32), np.array([], dtype=object))
+        if not os.path.isfile(path):
+            return empty
+        with np.load(path) as data:
+            if int(data['version']) != tokenCacheVersion or str(data['signature']) != signature:
+                return empty
+            hashes = [row.tobytes() for row in data['hashes']]
+            terms = data['termBytes'].tobytes().decode('utf-8').split('\n') if len(data['termBytes']) > 0 else []
+            return cls(hashes, data['docOffsets'], data['tokenIds'], np.array(terms, dtype=object))
+
+# Writes the tokens of songs (list of token lists, with the hash of each song text) to a token cache file.
+# The file is written under a temporary name and then renamed, so an interrupted write keeps the previous cache.
+def saveTokenCache(path, signature, hashes, corpus):
+    termIds = {}
+    docOffsets = np.zeros(len(corpus) + 1, dtype=np.int64)
+    docOffsets[1:] = np.cumsum([len(tokens) for tokens in corpus])
+    tokenIds = np.fromiter((termIds.setdefault(token, len(termIds)) for tokens in corpus for token in tokens), dtype=np.int32, count=docOffsets[-1])
+    # Tokens are alphabetic, so they never contain the separator
+    termBytes = np.frombuffer('\n'.join(termIds).encode('utf-8'), dtype=np.uint8)
+    hashArray = np.frombuffer(b''.join(hashes), dtype=np.uint8).reshape(-1, hashlib.sha1().digest_size)
+
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, version=tokenCacheVersion, signature=signature, hashes=hashArray, docOffsets=docOffsets, tokenIds=tokenIds, termBytes=termBytes)
+    os.replace(path + '.tmp', path)